@@ -0,0 +1,122 @@
+'''
+Methods to apply queued metadata edits to many videos concurrently.
+
+The edits run on a pool of worker threads. A per-device semaphore caps how
+many of them touch the same filesystem at once so that spinning disks aren't
+made to seek between files, while edits spread over several devices still
+run side by side. Results are reported in the order of the input list
+regardless of the order in which the edits finish.
+'''
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from _logs import warning, debug, metrics
+
+# Default number of edits running at once
+DEFAULT_WORKERS = 4
+# Default number of edits running at once on a single device
+DEFAULT_DEVICE_LIMIT = 2
+
+
+class ApplyEngine:
+    '''Class to run the metadata edits of a list of videos'''
+
+    def __init__(self, workers=None, device_limit=None):
+
+        # Store the total number of edits allowed to run at once
+        self.workers = workers or DEFAULT_WORKERS
+        # Store the number of edits allowed to run at once per device
+        self.device_limit = device_limit or DEFAULT_DEVICE_LIMIT
+        # Map each device ID to the semaphore guarding it
+        self._devices = {}
+        self._devices_lock = threading.Lock()
+        # Store the position of the first fatal failure so that the edits
+        # queued after it are skipped, like a sequential run would
+        self._stop_index = None
+        self._stop_lock = threading.Lock()
+
+    def _device_semaphore(self, path):
+        '''Returns the semaphore of the device holding `path`'''
+
+        try:
+            device = os.stat(os.path.dirname(path) or '.').st_dev
+        except OSError:
+            device = None
+        with self._devices_lock:
+            if device not in self._devices:
+                self._devices[device] = threading.BoundedSemaphore(
+                    self.device_limit)
+            return self._devices[device]
+
+    def _stopped(self, index):
+        '''Checks whether a fatal failure happened before position `index`'''
+
+        with self._stop_lock:
+            return self._stop_index is not None and self._stop_index < index
+
+    def _apply(self, index, video):
+        '''Applies the metadata of a single video, returns its status code
+        or `None` if it was skipped after a fatal error, and the number of
+        seconds the edit took'''
+
+        with self._device_semaphore(video.current_path):
+            if self._stopped(index):
+                return None, 0.0
+            start = time.perf_counter()
+            status_code = video.update_metadata_fields()
+            elapsed = time.perf_counter() - start
+        metrics.observe('apply.metadata', start, elapsed)
+        if status_code == 2:
+            with self._stop_lock:
+                if self._stop_index is None or index < self._stop_index:
+                    self._stop_index = index
+        return status_code, elapsed
+
+    def apply_metadata(self, videos, report=None):
+        '''
+        Applies the metadata of every video in `videos`. Returns 1 if any
+        edit failed fatally, in which case the edits after it that hadn't
+        started are skipped, and 0 otherwise. Edits that finished with
+        warnings are listed after the others.
+
+        `report` is called with each video, its status code and the number
+        of seconds its edit took, in input order as soon as they are known.
+        '''
+
+        self._stop_index = None
+        with metrics.timer('phase.apply'), \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return report_results(videos, executor.map(
+                self._apply, range(len(videos)), videos), report)
+
+
+def report_results(videos, results, report=None):
+    '''
+    Reports the `results` of the edits of `videos`, pairs of the status
+    code of an edit, or `None` if it was skipped, and the number of seconds
+    it took, in input order. Returns 1 if any edit failed fatally and 0
+    otherwise. See `ApplyEngine.apply_metadata` for `report`.
+    '''
+
+    warned = []
+    failed = False
+    metrics.count('files.apply', len(videos))
+    for video, (status_code, elapsed) in zip(videos, results):
+        if report is not None:
+            report(video, status_code, elapsed)
+        if status_code is None:
+            metrics.count('apply.skipped')
+            continue
+        metrics.count('apply.status.' + str(status_code))
+        if status_code == 2:
+            failed = True
+            continue
+        if status_code == 1:
+            warned.append(video)
+        debug("Applied change for video - %s", "run", video.current_path)
+
+    for video in warned:
+        warning("Applied with warnings - " + video.current_path, "apply")
+    return 1 if failed else 0
@@ -0,0 +1,206 @@
+'''
+Asyncio pipeline to run the external tools of the probe and apply stages.
+
+The pipeline runs an event loop on a background thread, so that the
+blocking prompts of the interactive modes keep working while titles arrive.
+mediainfo and the title editors are started with
+`asyncio.create_subprocess_exec`, without a shell, and a semaphore caps how
+many of them run at once. The built-in parsers and writers don't start any
+process and run on the default executor of the loop instead.
+
+Titles are fetched in small batches and handed to the video objects as soon
+as each batch is done, so a video can be shown while the titles of the
+videos after it are still being fetched. Metadata edits are reported in the
+order of the input list like `ApplyEngine` does.
+'''
+
+import asyncio
+import sys
+import threading
+import time
+from _logs import warning, debug, metrics
+from _apply import report_results
+from _backends import group_by_backend
+from _mediainfo import chunk_paths, command, report_timeout, check_result, \
+    match_titles
+
+# Default number of external processes running at once
+DEFAULT_CONCURRENCY = 8
+# Number of videos whose titles are fetched together, kept small so that
+# the first titles arrive quickly
+BATCH_SIZE = 8
+
+
+class AsyncPipeline:
+    '''Class to run the external tools on an event loop in the background'''
+
+    def __init__(self, concurrency=None):
+
+        # Store the number of processes allowed to run at once
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 8):
+            # Older versions only reap the children of the loop attached
+            # from the main thread
+            asyncio.get_child_watcher().attach_loop(self.loop)
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self._semaphore = self._call(self._create_semaphore()).result()
+        # Store the position of the first fatal failure of a batch of edits
+        self._stop_index = None
+
+    async def _create_semaphore(self):
+        # The semaphore has to be created on the loop it guards
+        return asyncio.Semaphore(self.concurrency)
+
+    def _call(self, coroutine):
+        '''Schedules `coroutine` on the loop, returns a concurrent future'''
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _exec(self, arguments, timeout=None):
+        '''
+        Runs the command `arguments` once a slot is free and returns its
+        exit code and output. Raises `asyncio.TimeoutError` if it takes
+        longer than `timeout` seconds and `OSError` if it can't be started.
+        '''
+
+        async with self._semaphore:
+            metrics.count('subprocess.' + arguments[0])
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *arguments, stdout=asyncio.subprocess.PIPE)
+            try:
+                output, _ = await asyncio.wait_for(
+                    process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise
+            finally:
+                metrics.observe('async.' + arguments[0], start,
+                                time.perf_counter() - start)
+        return process.returncode, output.decode('utf-8', 'replace')
+
+    async def _probe_chunk(self, chunk, timeout, titles):
+        '''Runs mediainfo on a single chunk of paths'''
+
+        metrics.count('files.mediainfo', len(chunk))
+        try:
+            returncode, output = await self._exec(
+                command(chunk), None if timeout is None
+                else timeout * len(chunk))
+        except asyncio.TimeoutError:
+            report_timeout(chunk)
+            return
+        except OSError as exc:
+            warning("Failed to run mediainfo: " + str(exc), "async")
+            return
+        match_titles(chunk, check_result(chunk, returncode, output), titles)
+
+    async def _load_batch(self, video_class, videos):
+        '''Fetches the titles of a batch of videos of `video_class`'''
+
+        titles, stats, missing = await self.loop.run_in_executor(
+            None, video_class.load_local_many, videos)
+        probed = {}
+        if missing:
+            await asyncio.gather(*[
+                self._probe_chunk(chunk, videos[0].timeout, probed)
+                for chunk in chunk_paths(list(missing))])
+        return video_class.merge_probed(titles, stats, missing, probed)
+
+    async def _fetch_batch(self, video_class, videos):
+        '''Fetches a pending batch and hands the titles to the videos'''
+
+        videos = video_class.start_batch(videos)
+        if not videos:
+            return
+        try:
+            titles = await self._load_batch(video_class, videos)
+        except Exception as exc:
+            video_class.finish_batch(videos, exception=exc)
+            return
+        video_class.finish_batch(videos, titles)
+
+    def prefetch(self, videos):
+        '''Schedules the titles of `videos` to be fetched in the background,
+        each of them can be read as soon as its batch is done'''
+
+        for video_class, group in group_by_backend(videos).items():
+            for batch in video_class.pending_batches(group, BATCH_SIZE):
+                self._call(self._fetch_batch(video_class, batch))
+
+    def probe_videos(self, videos):
+        '''Fetches the title of every video in `videos` and returns the list
+        once all of them are known'''
+
+        debug("Probing %d videos with asyncio.", "async", len(videos))
+        metrics.count('files.probe', len(videos))
+        with metrics.timer('phase.probe'):
+            self.prefetch(videos)
+            for video in videos:
+                _ = video.current_metadata_title
+        return videos
+
+    def _stopped(self, index):
+        '''Checks whether a fatal failure happened before position `index`,
+        only called on the loop'''
+
+        return self._stop_index is not None and self._stop_index < index
+
+    async def _apply(self, index, video):
+        '''Applies the metadata of a single video, returns its status code
+        or `None` if it was skipped after a fatal error, and the number of
+        seconds the edit took'''
+
+        if self._stopped(index):
+            return None, 0.0
+        start = time.perf_counter()
+        changed = video.title_changed()
+        arguments = video.edit_command() if changed else None
+        if not changed:
+            status_code = 0
+        elif arguments is None:
+            # Backends without a command edit the file in process
+            status_code = await self.loop.run_in_executor(
+                None, video.update_metadata_fields)
+        elif await self.loop.run_in_executor(None, video.write_native):
+            status_code = video.title_written(0)
+        else:
+            try:
+                returncode, output = await self._exec(arguments)
+            except OSError as exc:
+                warning("Failed to run {0}: {1}".format(
+                    arguments[0], exc), "async")
+                status_code = 2
+            else:
+                status_code = video.title_written(
+                    video.edit_status(returncode, output))
+        elapsed = time.perf_counter() - start
+        metrics.observe('apply.metadata', start, elapsed)
+        if status_code == 2 and (self._stop_index is None or
+                                 index < self._stop_index):
+            self._stop_index = index
+        return status_code, elapsed
+
+    def apply_metadata(self, videos, report=None):
+        '''
+        Applies the metadata of every video in `videos`, with the same
+        status codes and reports as `ApplyEngine.apply_metadata`.
+        '''
+
+        self._stop_index = None
+        with metrics.timer('phase.apply'):
+            futures = [self._call(self._apply(index, video))
+                       for index, video in enumerate(videos)]
+            return report_results(
+                videos, (future.result() for future in futures), report)
+
+    def close(self):
+        '''Stops the event loop once the scheduled work is done'''
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
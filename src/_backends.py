@@ -0,0 +1,114 @@
+'''
+Registry of the container backends.
+
+Every backend is a Video subclass registered under the container name used
+by `--types`, along with a test of the first bytes of a file. Backends are
+registered by module and class name, and a module is only imported once a
+file of its container turns up. The backend of a file is picked by its
+signature, so that a mp4 saved as .mkv still ends up with the right parser,
+and by its extension only when the file can't be read or its signature is
+unknown. Videos can then be grouped by backend so that each backend probes
+and applies its own files in one batch.
+'''
+
+from collections import OrderedDict, namedtuple
+from importlib import import_module
+from _scanner import EXTENSION_SETS
+
+# Number of bytes read to identify a container
+SNIFF_SIZE = 12
+
+# Describes a registered backend
+Backend = namedtuple('Backend', ['name', 'module', 'class_name', 'test'])
+
+# Map each container name to its backend, in order of precedence
+BACKENDS = OrderedDict()
+# Map the container names to the video classes imported so far
+_CLASSES = {}
+
+
+def register(name, module, class_name, test):
+    '''Registers the class `class_name` of `module` for the container
+    `name`, `test` checks whether the first bytes of a file belong to the
+    container'''
+
+    BACKENDS[name] = Backend(name, module, class_name, test)
+
+
+def video_class(name):
+    '''Returns the video class of the container `name`, importing its
+    module the first time it is needed'''
+
+    if name not in _CLASSES:
+        backend = BACKENDS[name]
+        _CLASSES[name] = getattr(import_module(backend.module),
+                                 backend.class_name)
+    return _CLASSES[name]
+
+
+def _is_matroska(head):
+    '''Checks for the EBML magic number'''
+
+    return head[:4] == b'\x1a\x45\xdf\xa3'
+
+
+def _is_mpeg4(head):
+    '''Checks for a leading `ftyp` atom'''
+
+    return head[4:8] == b'ftyp'
+
+
+def _is_avi(head):
+    '''Checks for a RIFF file of the AVI form'''
+
+    return head[:4] == b'RIFF' and head[8:12] == b'AVI '
+
+
+register('mkv', 'file_mkv', 'Matroska', _is_matroska)
+register('mp4', 'file_mp4', 'Mpeg4', _is_mpeg4)
+
+# Map the containers that are recognized but can't be edited yet to their
+# tests, so that they aren't mistaken for another container by extension
+UNSUPPORTED = OrderedDict([('avi', _is_avi)])
+
+
+def sniff(path):
+    '''Returns the container name of the file at `path`, or `None` if it
+    can't be identified'''
+
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(SNIFF_SIZE)
+    except OSError:
+        head = b''
+
+    for backend in BACKENDS.values():
+        if backend.test(head):
+            return backend.name
+    for name, test in UNSUPPORTED.items():
+        if test(head):
+            return name
+
+    # Fall back to the extension for unreadable or unknown files
+    lower_path = path.lower()
+    for name, extensions in EXTENSION_SETS.items():
+        if lower_path.endswith(extensions):
+            return name
+    return None
+
+
+def backend_for(path):
+    '''Returns the video class to handle the file at `path`, or `None` if
+    its container isn't supported'''
+
+    name = sniff(path)
+    return video_class(name) if name in BACKENDS else None
+
+
+def group_by_backend(videos):
+    '''Returns the videos of each video class, in order of appearance'''
+
+    groups = OrderedDict()
+    for video in videos:
+        groups.setdefault(type(video), []).append(video)
+    return groups
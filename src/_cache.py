@@ -0,0 +1,175 @@
+'''
+Persistent cache of the titles probed from video files.
+
+The cache is a SQLite database in the user's cache directory. Entries are
+keyed by the device and inode of a file and are only trusted while the size
+and modification time of the file are unchanged, so renamed files keep their
+entry and edited files are probed again. The least recently used entries are
+evicted once the cache grows past its size limit.
+
+The SqliteStore class holds what the cache shares with the other databases
+of the cache directory. Every statement commits on its own and the database
+uses write-ahead logging, so a long running process such as the watch mode
+never holds the write lock between statements and other runs can share the
+database. A locked or unreadable database only turns lookups into misses.
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from _logs import warning, debug
+from _stores import default_cache_path
+
+# Default number of entries kept in a database
+DEFAULT_MAX_ENTRIES = 200000
+# Number of writes between two checks of the size limit
+EVICT_INTERVAL = 1000
+
+
+class SqliteStore:
+    '''
+    Base class of the databases in the cache directory. Subclasses name
+    their `table`, the `schema` statements creating it and the `order`
+    column by which the oldest entries are evicted.
+    '''
+
+    # Store the names used in log messages
+    sign = "cache"
+    description = "Database"
+    table = None
+    schema = ()
+    order = None
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+
+        # Store the location of the database
+        self.path = path
+        # Store the number of entries kept before evicting old ones
+        self.max_entries = max_entries
+        # Store the number of writes since the last eviction check
+        self._writes = 0
+        # The connection is shared by the worker threads of a run
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Commit every statement so that the write lock is only held while
+        # it runs, concurrent runs wait for it for a while at most
+        self._connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None,
+            check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.schema:
+            self._connection.execute(statement)
+        debug("Opened " + self.path, self.sign)
+
+    @classmethod
+    def open(cls, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        '''Opens the database, returns `None` if it can't be used'''
+
+        try:
+            return cls(path, max_entries)
+        except (OSError, sqlite3.Error) as exc:
+            warning(cls.description + " disabled: " + str(exc), cls.sign)
+            return None
+
+    def _execute(self, statement, parameters=()):
+        '''Runs `statement`, returns the rows it fetched or `None` if the
+        database failed'''
+
+        with self._lock:
+            try:
+                return self._connection.execute(
+                    statement, parameters).fetchall()
+            except sqlite3.Error as exc:
+                debug("Database statement failed: " + str(exc), self.sign)
+                return None
+
+    def _insert(self, values):
+        '''Stores the row `values`, replacing the entry with its key'''
+
+        self._execute('INSERT OR REPLACE INTO {0} VALUES ({1})'.format(
+            self.table, ', '.join('?' * len(values))), values)
+        self._writes += 1
+        if self._writes >= EVICT_INTERVAL:
+            self._evict()
+
+    def _evict(self):
+        '''Removes the oldest entries beyond the size limit'''
+
+        self._writes = 0
+        rows = self._execute('SELECT COUNT(*) FROM ' + self.table)
+        if rows and rows[0][0] > self.max_entries:
+            self._execute(
+                'DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} '
+                'ORDER BY {1} LIMIT ?)'.format(self.table, self.order),
+                (rows[0][0] - self.max_entries,)
+            )
+            debug("Evicted {0} entries.".format(
+                rows[0][0] - self.max_entries), self.sign)
+
+    def close(self):
+        '''Evicts the entries beyond the size limit and closes the
+        database'''
+
+        self._evict()
+        with self._lock:
+            self._connection.close()
+
+
+class MetadataCache(SqliteStore):
+    '''Class to store and look up probed titles across runs'''
+
+    description = "Metadata cache"
+    table = 'titles'
+    schema = (
+        'CREATE TABLE IF NOT EXISTS titles ('
+        'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+        'title TEXT, accessed REAL, PRIMARY KEY (device, inode))',
+        'CREATE INDEX IF NOT EXISTS titles_accessed ON titles (accessed)',
+    )
+    order = 'accessed'
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        super().__init__(path or default_cache_path(), max_entries)
+
+    def get(self, stat):
+        '''
+        Returns the cached title of the file described by the `os.stat`
+        result `stat`, or `None` if there is no valid entry.
+        '''
+
+        rows = self._execute(
+            'SELECT size, mtime_ns, title FROM titles '
+            'WHERE device = ? AND inode = ?',
+            (stat.st_dev, stat.st_ino)
+        )
+        if not rows:
+            return None
+        size, mtime_ns, title = rows[0]
+        # Drop the entry if the file has been modified since
+        if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+            self._execute(
+                'DELETE FROM titles WHERE device = ? AND inode = ?',
+                (stat.st_dev, stat.st_ino)
+            )
+            return None
+        self._execute(
+            'UPDATE titles SET accessed = ? WHERE device = ? AND inode = ?',
+            (time.time(), stat.st_dev, stat.st_ino)
+        )
+        return title
+
+    def put(self, stat, title):
+        '''Stores `title` for the file described by the `os.stat` result
+        `stat`'''
+
+        self._insert((stat.st_dev, stat.st_ino, stat.st_size,
+                      stat.st_mtime_ns, title, time.time()))
+
+
+def open_cache(path=None, max_entries=DEFAULT_MAX_ENTRIES):
+    '''Opens the metadata cache, returns `None` if it can't be used'''
+
+    return MetadataCache.open(path, max_entries)
@@ -0,0 +1,34 @@
+'''
+Methods to compare the planned state of a batch against the current one.
+
+Running a pattern again over a directory that was already edited plans the
+same paths and titles the files already have. Comparing every planned
+value with the current one keeps those files out of the batch, so that
+neither the title editors nor the renames run for them. The current titles
+come from the title cache as long as the files haven't changed since they
+were last probed, which makes a run over a finished library cheap.
+'''
+
+import os
+from _logs import debug, metrics
+
+
+def is_changed(video):
+    '''Checks whether applying the edits of `video` would change the file'''
+
+    return video.title_changed() or \
+        os.path.abspath(video.current_path) != \
+        os.path.abspath(video.set_path)
+
+
+def plan_delta(videos):
+    '''Returns the videos of `videos` whose edits would change anything, in
+    order, and the number of videos that already match their plan'''
+
+    changed = [video for video in videos if is_changed(video)]
+    skipped = len(videos) - len(changed)
+    metrics.count('plan.changed', len(changed))
+    metrics.count('plan.skipped', skipped)
+    debug("%d videos to change, %d already match", "delta",
+          len(changed), skipped)
+    return changed, skipped
@@ -0,0 +1,336 @@
+'''
+Minimal EBML parser and title writer for Matroska files.
+
+Only the handful of elements needed to locate the Segment Info are
+understood. The parser reads element headers with small bounded reads and
+follows the SeekHead to the Info element instead of walking the clusters, so
+fetching the title costs a few kilobytes of I/O regardless of the file size.
+
+The writer replaces the Title element in place when the new title fits in
+the space taken by the old one and any Void elements next to it. Anything
+that would change the size of the Segment Info is left to mkvpropedit.
+
+Matroska specification - https://www.matroska.org/technical/elements.html
+'''
+
+import os
+from collections import namedtuple
+
+# Element IDs used by the parser, including their length marker bits
+EBML_ID = 0x1A45DFA3
+DOCTYPE_ID = 0x4282
+SEGMENT_ID = 0x18538067
+SEEKHEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ID_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+INFO_ID = 0x1549A966
+TITLE_ID = 0x7BA9
+CLUSTER_ID = 0x1F43B675
+VOID_ID = 0xEC
+CRC32_ID = 0xBF
+
+# Document types that use the Matroska element layout
+DOCTYPES = {b'matroska', b'webm'}
+
+# Largest element header: a 4 byte ID followed by an 8 byte size
+MAX_HEADER_SIZE = 12
+# Upper bounds on the amount of data read while looking for the title
+MAX_HEADER_ELEMENT_SIZE = 4096
+MAX_INFO_SIZE = 1 << 20
+MAX_TOP_LEVEL_ELEMENTS = 64
+
+# Describes a parsed element. `offset` is the position of its ID, `data`
+# the position of its payload and `size` the length of the payload.
+Element = namedtuple('Element', ['id', 'offset', 'data', 'size'])
+
+
+class EBMLError(Exception):
+    '''Raised when a file can't be understood by the parser'''
+
+
+def decode_vint(buffer, pos, keep_marker=False):
+    '''
+    Decodes the variable length integer starting at `buffer[pos]`. Returns
+    the value and its length in bytes. The size of an element with an
+    unknown length is returned as `None`.
+    '''
+
+    if pos >= len(buffer):
+        raise EBMLError("Truncated variable length integer.")
+    first = buffer[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8 or pos + length > len(buffer):
+        raise EBMLError("Invalid variable length integer.")
+
+    value = first if keep_marker else first & (mask - 1)
+    all_ones = first & (mask - 1) == mask - 1
+    for byte in buffer[pos + 1:pos + length]:
+        value = (value << 8) | byte
+        all_ones = all_ones and byte == 0xFF
+    if all_ones and not keep_marker:
+        return None, length
+    return value, length
+
+
+def encode_size(size, length=None):
+    '''Encodes the element size `size` as a variable length integer of
+    `length` bytes, using the shortest length if none is given'''
+
+    if length is None:
+        length = 1
+        # All ones is reserved for unknown sizes
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    if length > 8 or size >= (1 << (7 * length)) - 1:
+        raise EBMLError("Element size doesn't fit the requested length.")
+    return ((1 << (7 * length)) | size).to_bytes(length, 'big')
+
+
+def encode_id(element_id):
+    '''Encodes an element ID, which already carries its length marker'''
+
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+
+def parse_header(buffer, pos, offset=0):
+    '''Parses the element header at `buffer[pos]`, `offset` is the file
+    position of the start of `buffer`'''
+
+    element_id, id_length = decode_vint(buffer, pos, keep_marker=True)
+    size, size_length = decode_vint(buffer, pos + id_length)
+    data = pos + id_length + size_length
+    return Element(element_id, offset + pos, offset + data, size)
+
+
+def read_at(file, offset, size):
+    '''Reads at most `size` bytes at `offset` of the open file `file`'''
+
+    file.seek(offset)
+    return file.read(size)
+
+
+def read_element(file, offset):
+    '''Reads the header of the element starting at `offset`'''
+
+    buffer = read_at(file, offset, MAX_HEADER_SIZE)
+    if not buffer:
+        return None
+    return parse_header(buffer, 0, offset)
+
+
+def iter_children(buffer, offset=0):
+    '''Yields the elements stored back to back in `buffer`'''
+
+    pos = 0
+    while pos < len(buffer):
+        element = parse_header(buffer, pos, offset)
+        if element.size is None:
+            raise EBMLError("Unknown size inside a master element.")
+        yield element
+        pos = element.data - offset + element.size
+
+
+def read_uint(buffer):
+    '''Decodes a big endian unsigned integer element payload'''
+
+    return int.from_bytes(buffer, 'big')
+
+
+def find_segment(file):
+    '''Checks the EBML header and returns the Segment element'''
+
+    header = read_element(file, 0)
+    if header is None or header.id != EBML_ID:
+        raise EBMLError("Not an EBML file.")
+    if header.size is None or header.size > MAX_HEADER_ELEMENT_SIZE:
+        raise EBMLError("Invalid EBML header.")
+
+    body = read_at(file, header.data, header.size)
+    doctype = None
+    for child in iter_children(body, header.data):
+        if child.id == DOCTYPE_ID:
+            start = child.data - header.data
+            doctype = body[start:start + child.size].rstrip(b'\0')
+    if doctype not in DOCTYPES:
+        raise EBMLError("Unsupported document type.")
+
+    segment = read_element(file, header.data + header.size)
+    if segment is None or segment.id != SEGMENT_ID:
+        raise EBMLError("Segment not found.")
+    return segment
+
+
+def find_info(file):
+    '''
+    Returns the Segment Info element of the Matroska file `file`, following
+    the SeekHead if the Info element isn't among the first elements.
+    '''
+
+    segment = find_segment(file)
+    pos = segment.data
+    seek_target = None
+
+    for _ in range(MAX_TOP_LEVEL_ELEMENTS):
+        element = read_element(file, pos)
+        if element is None:
+            break
+        if element.id == INFO_ID:
+            return element
+        if element.size is None:
+            raise EBMLError("Unknown size at the top level.")
+
+        if element.id == SEEKHEAD_ID and seek_target is None:
+            seek_target = _seek_info(file, element, segment.data)
+            if seek_target is not None:
+                pos = seek_target
+                continue
+        # The title is never stored after the first cluster
+        elif element.id == CLUSTER_ID:
+            break
+        pos = element.data + element.size
+
+    raise EBMLError("Segment Info not found.")
+
+
+def _seek_info(file, seekhead, segment_data):
+    '''Returns the file position of the Info element listed in the
+    SeekHead `seekhead`, if any'''
+
+    if seekhead.size > MAX_INFO_SIZE:
+        raise EBMLError("SeekHead too large.")
+    body = read_at(file, seekhead.data, seekhead.size)
+    info_id = encode_id(INFO_ID)
+
+    for seek in iter_children(body, seekhead.data):
+        if seek.id != SEEK_ID:
+            continue
+        start = seek.data - seekhead.data
+        target = position = None
+        for child in iter_children(body[start:start + seek.size], seek.data):
+            value = body[child.data - seekhead.data:
+                         child.data - seekhead.data + child.size]
+            if child.id == SEEK_ID_ID:
+                target = value
+            elif child.id == SEEK_POSITION_ID:
+                position = read_uint(value)
+        if target == info_id and position is not None:
+            return segment_data + position
+    return None
+
+
+def read_info(file):
+    '''Returns the Info element and its payload'''
+
+    info = find_info(file)
+    if info.size is None or info.size > MAX_INFO_SIZE:
+        raise EBMLError("Invalid Segment Info size.")
+    body = read_at(file, info.data, info.size)
+    if len(body) != info.size:
+        raise EBMLError("Truncated Segment Info.")
+    return info, body
+
+
+def read_title(path):
+    '''
+    Returns the title stored in the Segment Info of the Matroska file at
+    `path`, or an empty string if it has none. Raises `EBMLError` if the
+    file can't be parsed.
+    '''
+
+    with open(path, 'rb') as file:
+        info, body = read_info(file)
+
+    for child in iter_children(body, info.data):
+        if child.id == TITLE_ID:
+            start = child.data - info.data
+            try:
+                return body[start:start + child.size].rstrip(b'\0') \
+                    .decode('utf-8')
+            except UnicodeDecodeError:
+                raise EBMLError("Title is not valid UTF-8.")
+    return ''
+
+
+def _encode_region(payload, length):
+    '''
+    Encodes a Title element holding `payload` followed by a Void element so
+    that both take exactly `length` bytes. Returns `None` if that isn't
+    possible.
+    '''
+
+    title_id = encode_id(TITLE_ID)
+    # Widening the size field of the title absorbs leftovers too small
+    # for a Void element
+    for size_length in range(1, 9):
+        try:
+            title = title_id + encode_size(len(payload), size_length) + \
+                payload
+        except EBMLError:
+            continue
+        leftover = length - len(title)
+        if leftover < 0:
+            return None
+        if leftover == 0:
+            return title
+        for void_length in range(1, 9):
+            void_size = leftover - 1 - void_length
+            if void_size < 0:
+                break
+            try:
+                return title + encode_id(VOID_ID) + \
+                    encode_size(void_size, void_length) + b'\0' * void_size
+            except EBMLError:
+                continue
+    return None
+
+
+def write_title(path, title):
+    '''
+    Replaces the title of the Matroska file at `path` in place. Returns
+    `False` without modifying the file if the new title doesn't fit in the
+    existing Title and Void elements. Raises `EBMLError` if the file can't be
+    parsed.
+    '''
+
+    payload = title.encode('utf-8')
+
+    with open(path, 'r+b') as file:
+        info, body = read_info(file)
+
+        children = list(iter_children(body, info.data))
+        # The checksum would have to be recomputed for any change
+        if any(child.id == CRC32_ID for child in children):
+            return False
+
+        # Start from the existing title, or the first Void if there is none
+        ids = [child.id for child in children]
+        if TITLE_ID in ids:
+            first = last = ids.index(TITLE_ID)
+        elif VOID_ID in ids:
+            first = last = ids.index(VOID_ID)
+        else:
+            return False
+        # Grow the region over the Void elements around it
+        while first > 0 and ids[first - 1] == VOID_ID:
+            first -= 1
+        while last + 1 < len(ids) and ids[last + 1] == VOID_ID:
+            last += 1
+        start = children[first].offset
+        end = children[last].data + children[last].size
+
+        region = _encode_region(payload, end - start)
+        if region is None:
+            return False
+
+        # Replace the whole region with a single write and make sure it
+        # reaches the disk before reporting success
+        file.seek(start)
+        file.write(region)
+        file.flush()
+        os.fsync(file.fileno())
+    return True
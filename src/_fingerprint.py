@@ -0,0 +1,128 @@
+'''
+Content fingerprints of video files and the index of the titles written.
+
+A fingerprint hashes the size of a file and a few blocks sampled across it,
+leaving out the start and the end of the file where the containers keep the
+title, so that it stays the same when the file is retitled or moved and only
+costs a handful of reads on files of any size. The blocks are read with
+`os.pread` where available.
+
+The FingerprintIndex class stores the fingerprint of every video whose title
+has been written, along with the title, in a SQLite database next to the
+metadata cache. A file that has been moved to another device or restored
+from a copy has a new inode and misses the metadata cache, but its title can
+still be looked up by its fingerprint instead of starting mediainfo. Entries
+are only trusted while the modification time of the file is unchanged. The
+fingerprints also let a batch refuse to rename a video onto a copy of itself.
+'''
+
+import hashlib
+import os
+import time
+from _logs import debug
+from _cache import DEFAULT_MAX_ENTRIES, SqliteStore
+from _stores import default_cache_path
+
+# Number of blocks hashed per file and their size in bytes
+SAMPLES = 4
+SAMPLE_SIZE = 65536
+# Number of bytes left out at the start and the end of a file
+HEADER_SIZE = 1 << 20
+TRAILER_SIZE = 1 << 20
+
+
+def _read_at(file, offset, length):
+    '''Reads `length` bytes of `file` at `offset`'''
+
+    if hasattr(os, 'pread'):
+        return os.pread(file.fileno(), length, offset)
+    file.seek(offset)
+    return file.read(length)
+
+
+def fingerprint(path, size=None):
+    '''Returns the fingerprint of the file at `path` as a hex string, `size`
+    is the size of the file if it is already known'''
+
+    with open(path, 'rb') as file:
+        if size is None:
+            size = os.fstat(file.fileno()).st_size
+        # Small files give up a quarter at each end at most
+        start = min(HEADER_SIZE, size // 4)
+        end = size - min(TRAILER_SIZE, size // 4)
+        span = max(0, end - start - SAMPLE_SIZE)
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        for index in range(SAMPLES):
+            offset = start + span * index // (SAMPLES - 1)
+            digest.update(_read_at(file, offset,
+                                   max(0, min(SAMPLE_SIZE, end - offset))))
+    return digest.hexdigest()
+
+
+def same_content(first, second):
+    '''Checks whether the files at `first` and `second` hold the same video,
+    judging by their fingerprints'''
+
+    try:
+        return fingerprint(first) == fingerprint(second)
+    except OSError:
+        return False
+
+
+class FingerprintIndex(SqliteStore):
+    '''Class to store and look up the titles written by fingerprint'''
+
+    sign = "fingerprint"
+    description = "Fingerprint index"
+    table = 'fingerprints'
+    schema = (
+        'CREATE TABLE IF NOT EXISTS fingerprints ('
+        'fingerprint TEXT, mtime_ns INTEGER, path TEXT, title TEXT, '
+        'seen REAL, PRIMARY KEY (fingerprint, mtime_ns))',
+        'CREATE INDEX IF NOT EXISTS fingerprints_seen ON fingerprints (seen)',
+    )
+    order = 'seen'
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        super().__init__(path or os.path.join(
+            os.path.dirname(default_cache_path()), 'fingerprints.sqlite3'),
+            max_entries)
+
+    def get(self, path, stat):
+        '''
+        Returns the title written to a file with the same content and
+        modification time as the file at `path`, described by the `os.stat`
+        result `stat`, and the path it was written to. Returns `None` if
+        there is no such entry.
+        '''
+
+        try:
+            key = fingerprint(path, stat.st_size)
+        except OSError:
+            return None
+        rows = self._execute(
+            'SELECT title, path FROM fingerprints '
+            'WHERE fingerprint = ? AND mtime_ns = ?',
+            (key, stat.st_mtime_ns)
+        )
+        if not rows:
+            return None
+        if rows[0][1] != path:
+            debug("%s has moved from %s", self.sign, path, rows[0][1])
+        return rows[0]
+
+    def put(self, path, stat, title):
+        '''Stores `title` for the file at `path`, described by the `os.stat`
+        result `stat`'''
+
+        try:
+            key = fingerprint(path, stat.st_size)
+        except OSError:
+            return
+        self._insert((key, stat.st_mtime_ns, path, title, time.time()))
+
+
+def open_fingerprints(path=None, max_entries=DEFAULT_MAX_ENTRIES):
+    '''Opens the fingerprint index, returns `None` if it can't be used'''
+
+    return FingerprintIndex.open(path, max_entries)
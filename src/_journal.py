@@ -0,0 +1,302 @@
+'''
+Write-ahead journal of the edits of a batch.
+
+Before anything is changed, every planned edit is written to a JSON lines
+journal and flushed to disk. Each title that has been written is then
+appended and flushed as soon as it is done. Every step of every rename,
+including the moves to temporary names, is recorded before it is made and
+again once it is done. After a crash or a fatal error the journal tells
+exactly which files still have their old title and where every file
+currently is, so that the batch can be resumed or rolled back without
+probing the files again. A rename that was recorded as about to happen has
+happened if its source is gone, files are never assumed to have moved just
+because their target exists.
+
+A journal looks like
+
+    {"op": "begin", "version": 1, "time": 1700000000.0}
+    {"op": "entry", "path": "...", "target_path": "...", ...}
+    {"op": "entry", "path": "...", "target_path": "...", "sidecar": true}
+    {"op": "titled", "path": "..."}
+    {"op": "moving", "path": "...", "from": "...", "to": "..."}
+    {"op": "moved", "path": "...", "to": "..."}
+    {"op": "commit"}
+
+where entries are identified by the path the file had when the batch began
+and the subtitle files moved along with a video have entries of their own.
+
+Every directory gets a journal of its own in the cache directory, named
+after a hash of its path, so that batches applied to different directories
+at the same time don't overwrite each other's journal.
+'''
+
+import glob
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from _logs import warning, debug
+from _stores import default_cache_path
+
+# Version of the journal format
+VERSION = 1
+
+
+def default_journal_path(root):
+    '''Returns the path of the journal of the batches applied to `root`,
+    next to the metadata cache'''
+
+    root = os.path.realpath(os.path.expanduser(root))
+    digest = hashlib.sha1(os.fsencode(root)).hexdigest()
+    return os.path.join(os.path.dirname(default_cache_path()),
+                        'journal-' + digest[:16] + '.jsonl')
+
+
+def journal_root(records):
+    '''Returns the directory holding every file of the plan entries
+    `records`, which picks their journal'''
+
+    if not records:
+        return os.getcwd()
+    return os.path.commonpath(
+        [os.path.dirname(record['path']) for record in records])
+
+
+def latest_journal():
+    '''Returns the path of the journal written last, or `None`'''
+
+    journals = glob.glob(os.path.join(
+        os.path.dirname(default_cache_path()), 'journal-*.jsonl'))
+    return max(journals, key=os.path.getmtime) if journals else None
+
+
+def journal_record(video):
+    '''Returns the journal entry of a video, the titles are only recorded
+    when a new one is queued'''
+
+    record = {'path': os.path.abspath(video.current_path),
+              'target_path': os.path.abspath(video.set_path)}
+    if video.title_changed():
+        record['title'] = video.current_metadata_title
+        record['target_title'] = video.set_metadata_title
+    return record
+
+
+def sidecar_record(move):
+    '''Returns the journal entry of the planned move of a subtitle file'''
+
+    return {'path': move.source, 'target_path': move.target, 'sidecar': True}
+
+
+class Journal:
+    '''
+    Class to record the progress of a batch as it is applied. `records` are
+    the journal entries of the batch. When a batch is resumed, `state` is
+    the progress read from its journal, which is carried over so that the
+    journal keeps describing the whole batch.
+    '''
+
+    def __init__(self, path, records, state=None):
+
+        # Store the location of the journal
+        self.path = path
+        # Entries that change nothing aren't recorded
+        records = [record for record in records
+                   if 'target_title' in record or
+                   record['path'] != record['target_path']]
+        # Map the current path of every file to the path that identifies
+        # its entry
+        self._keys = {record['path']: record['path'] for record in records}
+        # Store the entries that get a new title
+        self._retitled = {record['path'] for record in records
+                          if 'target_title' in record}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Write the new journal next to the old one, which is still needed
+        # until the new one is complete
+        temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+        self._file = open(temporary, 'w')
+        self._write({'op': 'begin', 'version': VERSION, 'time': time.time()},
+                    sync=False)
+        for record in records:
+            entry = {'op': 'entry'}
+            entry.update(record)
+            self._write(entry, sync=False)
+        if state is not None:
+            self._restore(records, state)
+        # Nothing may change before the whole plan is on disk
+        self._sync()
+        os.replace(temporary, path)
+        debug("Journaling %d entries to %s", "journal", len(records), path)
+
+    def _restore(self, records, state):
+        '''Records the progress of a resumed batch'''
+
+        for record in records:
+            key = record['path']
+            if key in state.titled:
+                self._write({'op': 'titled', 'path': key}, sync=False)
+            location = state.location(record)
+            if location != key:
+                del self._keys[key]
+                self._keys[location] = key
+                self._write({'op': 'moved', 'path': key, 'to': location},
+                            sync=False)
+
+    def _write(self, record, sync=True):
+        '''Appends `record` to the journal'''
+
+        self._file.write(json.dumps(record) + '\n')
+        if sync:
+            self._sync()
+
+    def _sync(self):
+        '''Makes sure the journal has reached the disk'''
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def titled(self, video, status_code, elapsed=None):
+        '''Records the title written to `video`, has the signature of the
+        reports of `ApplyEngine.apply_metadata`'''
+
+        key = self._keys.get(video.current_path, video.current_path)
+        if status_code in (0, 1) and key in self._retitled:
+            self._write({'op': 'titled', 'path': key})
+
+    def moving(self, source, target):
+        '''Records a rename step of the file at `source` before it is made,
+        has the signature of the intents of `RenamePlan.execute`'''
+
+        key = self._keys.get(source, source)
+        self._write({'op': 'moving', 'path': key, 'from': source,
+                     'to': target})
+
+    def moved(self, source, target):
+        '''Records a single rename step of the file at `source`, has the
+        signature of the steps of `RenamePlan.execute`'''
+
+        key = self._keys.pop(source, source)
+        self._keys[target] = key
+        self._write({'op': 'moved', 'path': key, 'to': target})
+
+    def commit(self):
+        '''Marks the batch as complete and closes the journal'''
+
+        self._write({'op': 'commit'})
+        self.close()
+
+    def close(self):
+        '''Closes the journal without marking the batch as complete'''
+
+        if not self._file.closed:
+            self._file.close()
+
+
+def open_journal(path, records, state=None):
+    '''Starts a journal, returns `None` if it can't be written'''
+
+    try:
+        return Journal(path, records, state)
+    except OSError as exc:
+        warning("Journal disabled: " + str(exc), "journal")
+        return None
+
+
+class JournalState:
+    '''Class to describe the progress recorded in a journal'''
+
+    def __init__(self):
+
+        # Map the path identifying every entry to the entry
+        self.entries = OrderedDict()
+        # Store the entries whose title has been written
+        self.titled = set()
+        # Map the entries that have moved to their last recorded path
+        self.locations = {}
+        # Map the entries with a rename step about to be made to its source
+        # and target
+        self.intents = {}
+        # Store whether the batch completed
+        self.committed = False
+
+    def location(self, record):
+        '''Returns the path where the file of an entry currently is'''
+
+        key = record['path']
+        intent = self.intents.get(key)
+        # The step may have happened right before the process died, renames
+        # are atomic so it did if its source is gone
+        if intent is not None and not os.path.lexists(intent[0]):
+            return intent[1]
+        return self.locations.get(key, key)
+
+    def remaining(self):
+        '''Returns the plan entries of the edits still to be made'''
+
+        records = []
+        for key, record in self.entries.items():
+            location = self.location(record)
+            remaining = {'path': location,
+                         'target_path': record['target_path']}
+            if record.get('sidecar'):
+                remaining['sidecar'] = True
+            if 'target_title' in record and key not in self.titled:
+                remaining['title'] = record['title']
+                remaining['target_title'] = record['target_title']
+            elif location == record['target_path']:
+                continue
+            records.append(remaining)
+        return records
+
+    def inverse(self):
+        '''Returns the plan entries that undo the edits made so far'''
+
+        records = []
+        for key, record in self.entries.items():
+            location = self.location(record)
+            inverse = {'path': location, 'target_path': key}
+            if record.get('sidecar'):
+                inverse['sidecar'] = True
+            if 'target_title' in record and key in self.titled:
+                inverse['title'] = record['target_title']
+                # A missing title is shown as N/A, restore it as empty
+                inverse['target_title'] = '' if record['title'] == "N/A" \
+                    else record['title']
+            elif location == key:
+                continue
+            records.append(inverse)
+        return records
+
+
+def read_journal(path):
+    '''Returns the state recorded in the journal at `path`'''
+
+    state = JournalState()
+    with open(path) as file:
+        lines = file.read().splitlines()
+    for line_number, line in enumerate(lines, 1):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Only the last line can be torn by a crash
+            if line_number == len(lines):
+                break
+            raise ValueError("Invalid journal entry on line {0}.".format(
+                line_number))
+        op = record.pop('op', None)
+        if op == 'begin' and record.get('version') != VERSION:
+            raise ValueError("Unsupported journal version.")
+        elif op == 'entry':
+            state.entries[record['path']] = record
+        elif op == 'titled':
+            state.titled.add(record['path'])
+        elif op == 'moving':
+            state.intents[record['path']] = (record['from'], record['to'])
+        elif op == 'moved':
+            state.locations[record['path']] = record['to']
+            state.intents.pop(record['path'], None)
+        elif op == 'commit':
+            state.committed = True
+    return state
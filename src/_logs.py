@@ -1,35 +1,213 @@
 '''
-Script to handle logging
+Script to handle logging and instrumentation
+
+Log messages are only formatted when a handler actually emits them, so debug
+calls on hot paths cost little more than a level check. Importing the module
+configures nothing, entry points that want the formatted output call
+`configure` once, otherwise only warnings and errors reach the standard
+error. The `metrics` object collects counters and latency histograms and can
+record a Chrome trace of the timed spans, see chrome://tracing or
+https://ui.perfetto.dev.
 '''
 
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
 from _colors import COLOR
 
-# Configure the logger object and set logging level
+# Store the logger shared by every module
 logger = logging.getLogger()
-# Add log handler
-ch = logging.StreamHandler()
-# Add message format
-formatter = logging.Formatter(
-    '%(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-logger.setLevel(logging.DEBUG)
 
 
-def warning(msg, sign="app"):
-    '''Logs a warning message'''
+def configure(verbose=False):
+    '''Adds the log handler of the scripts and sets the logging level,
+    debug messages are only shown if `verbose` is set'''
+
+    # Add log handler
+    ch = logging.StreamHandler()
+    # Add message format
+    formatter = logging.Formatter(
+        '%(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.DEBUG if verbose else logging.WARNING)
+
+
+class _Message:
+    '''Log message that is only formatted when it is emitted'''
+
+    __slots__ = ('color', 'sign', 'msg', 'args')
+
+    def __init__(self, color, sign, msg, args):
+        self.color = color
+        self.sign = sign
+        self.msg = msg
+        self.args = args
+
+    def __str__(self):
+        msg = self.msg % self.args if self.args else str(self.msg)
+        return COLOR[self.color] + self.sign + ": " + msg + COLOR["END"]
+
+
+def warning(msg, sign="app", *args):
+    '''Logs a warning message, `msg` is %-formatted with `args`'''
+
+    if logger.isEnabledFor(logging.WARNING):
+        logger.warning(_Message("YELLOW", sign, msg, args))
+
+
+def error(msg, sign="app", *args):
+    '''Logs an error message, `msg` is %-formatted with `args`'''
+
+    if logger.isEnabledFor(logging.ERROR):
+        logger.error(_Message("RED", sign, msg, args))
+
+
+def debug(msg, sign="app", *args):
+    '''Logs a debug message, `msg` is %-formatted with `args`'''
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(_Message("CYAN", sign, msg, args))
+
+
+class Histogram:
+    '''Class to summarize latencies in power of two millisecond buckets'''
+
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        # Map the upper bound of each bucket in milliseconds to its count
+        self.buckets = {}
+
+    def add(self, seconds):
+        '''Records a single latency'''
+
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+        bound = 1
+        while bound < seconds * 1000:
+            bound *= 2
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def summary(self):
+        '''Returns the histogram as a JSON serializable dictionary'''
+
+        return {
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total * 1000 / self.count, 3)
+            if self.count else None,
+            'min_ms': round(self.minimum * 1000, 3)
+            if self.minimum is not None else None,
+            'max_ms': round(self.maximum * 1000, 3)
+            if self.maximum is not None else None,
+            'buckets_ms': {'<=' + str(bound): count for bound, count
+                           in sorted(self.buckets.items())},
+        }
+
+
+class Metrics:
+    '''
+    Class to collect counters, latency histograms and trace spans. Nothing
+    is recorded until `enable` is called, so the instrumentation points cost
+    a single attribute check in normal runs.
+    '''
+
+    def __init__(self):
+
+        self.enabled = False
+        # Store whether every timed span is kept for the trace file
+        self.tracing = False
+        self.counters = {}
+        self.histograms = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def enable(self, tracing=False):
+        '''Starts recording, keeping the individual spans if `tracing`'''
+
+        self.enabled = True
+        self.tracing = tracing
+        self._start = time.perf_counter()
+
+    def count(self, name, value=1):
+        '''Adds `value` to the counter `name`'''
+
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, start, seconds):
+        '''Records a span of `seconds` that started at the perf_counter
+        value `start`'''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+            if self.tracing:
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': round((start - self._start) * 1e6, 1),
+                    'dur': round(seconds * 1e6, 1),
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                })
+
+    @contextmanager
+    def timer(self, name):
+        '''Times the enclosed block under `name`'''
+
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, start, time.perf_counter() - start)
+
+    def summary(self):
+        '''Returns the counters and histograms as a dictionary'''
 
-    logger.warning(COLOR["YELLOW"] + sign + ": " + msg + COLOR["END"])
+        with self._lock:
+            return {
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: histogram.summary() for name, histogram
+                               in sorted(self.histograms.items())},
+            }
 
+    def write_json(self, path):
+        '''Writes the counters and histograms to `path`'''
 
-def error(msg, sign="app"):
-    '''Logs an error message'''
+        import json
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=4)
 
-    logger.error(COLOR["RED"] + sign + ": " + msg + COLOR["END"])
+    def write_trace(self, path):
+        '''Writes the recorded spans to `path` in the Chrome trace format'''
 
+        import json
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      file)
 
-def debug(msg, sign="app"):
-    '''Logs a debug message'''
 
-    logger.debug(COLOR["CYAN"] + sign + ": " + msg + COLOR["END"])
+# Store the instrumentation shared by every module
+metrics = Metrics()
@@ -0,0 +1,153 @@
+'''
+Methods to fetch the titles of many files with a single mediainfo process.
+
+Starting mediainfo costs far more than reading the title of a file, so the
+files are passed to one process in chunks that stay below the argument size
+limit of the system. The output template wraps the path and the title of
+every file in markers, which lets the titles be matched back to the files
+even when they span several lines.
+
+Requires - mediainfo
+'''
+
+import os
+from _logs import warning, debug, metrics
+
+# Upper bound on the number of files passed to a single process
+MAX_FILES = 256
+# Argument size limit assumed when the system doesn't report one
+DEFAULT_ARG_MAX = 131072
+# Markers around the fields of each file in the output
+START = '<<vidrenamer>>'
+SEPARATOR = '<<title>>'
+END = '<</vidrenamer>>'
+TEMPLATE = 'General;' + START + '%CompleteName%' + SEPARATOR + '%Title%' + \
+    END + '\\n'
+
+
+def arg_limit():
+    '''Returns the number of bytes of arguments a single command may take'''
+
+    try:
+        limit = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        limit = DEFAULT_ARG_MAX
+    # The environment is passed in the same space
+    environment = sum(len(key) + len(value) + 2
+                      for key, value in os.environ.items())
+    # Keep half of what is left as a margin for the pointers
+    return max(4096, (limit - environment) // 2)
+
+
+def chunk_paths(paths, limit=None, max_files=MAX_FILES):
+    '''Splits `paths` into lists that fit on a single command line'''
+
+    limit = limit or arg_limit()
+    chunk = []
+    size = 0
+    for path in paths:
+        # Every argument also takes a terminator and a pointer
+        length = len(os.fsencode(path)) + 1 + 8
+        if chunk and (size + length > limit or len(chunk) == max_files):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(path)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def parse_output(output):
+    '''Returns the path and title of every file listed in the mediainfo
+    `output`, in order'''
+
+    records = []
+    for record in output.split(START)[1:]:
+        path, separator, rest = record.partition(SEPARATOR)
+        title, end, _ = rest.partition(END)
+        if separator and end:
+            records.append((path, title or "N/A"))
+    return records
+
+
+def command(paths):
+    '''Returns the mediainfo command that prints the titles of `paths`'''
+
+    return ['mediainfo', '--Inform=' + TEMPLATE] + paths
+
+
+def report_timeout(paths):
+    '''Reports a mediainfo run that took too long'''
+
+    warning("Mediainfo timed out.", "mediainfo")
+    warning(paths[0] if len(paths) == 1 else
+            "{0} files starting with {1}".format(len(paths), paths[0]),
+            "mediainfo")
+
+
+def check_result(paths, returncode, output):
+    '''Checks the result of a mediainfo run, returns its output'''
+
+    debug("mediainfo exited with %d for %d files", "mediainfo",
+          returncode, len(paths))
+    # Check if the mediainfo command ran successfully by looking at the
+    # return code, the files it did read are still listed
+    if returncode:
+        warning("Mediainfo failed to run correctly.", "mediainfo")
+    return output
+
+
+def _run(paths, timeout):
+    '''Runs mediainfo on `paths`, returns its output or `None`'''
+
+    # Only the files the built-in parsers can't handle need it
+    import subprocess
+
+    metrics.count('subprocess.mediainfo')
+    metrics.count('files.mediainfo', len(paths))
+    try:
+        with metrics.timer('probe.mediainfo'):
+            result = subprocess.run(
+                command(paths),
+                universal_newlines=True,
+                stdout=subprocess.PIPE,
+                timeout=timeout
+            )
+    except subprocess.TimeoutExpired:
+        report_timeout(paths)
+        return None
+    except OSError as exc:
+        warning("Failed to run mediainfo: " + str(exc), "mediainfo")
+        return None
+    return check_result(paths, result.returncode, result.stdout)
+
+
+def match_titles(chunk, output, titles):
+    '''Adds the titles of the files of `chunk` found in `output`'''
+
+    records = parse_output(output)
+    found = dict(records)
+    for index, path in enumerate(chunk):
+        if path in found:
+            titles[path] = found[path]
+        # mediainfo may print a normalized path, the order still matches
+        # when every file was read
+        elif len(records) == len(chunk):
+            titles[path] = records[index][1]
+
+
+def probe_titles(paths, timeout=None):
+    '''
+    Fetches the titles of the files at `paths` and returns them as a
+    dictionary, files that couldn't be probed are left out. `timeout` is the
+    number of seconds allowed per file.
+    '''
+
+    titles = {}
+    for chunk in chunk_paths(paths):
+        output = _run(chunk, None if timeout is None
+                      else timeout * len(chunk))
+        if output is not None:
+            match_titles(chunk, output, titles)
+    return titles
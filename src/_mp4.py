@@ -0,0 +1,329 @@
+'''
+Minimal atom parser and title writer for MP4 files.
+
+Only the path from the top level to the iTunes metadata list is understood,
+`moov/udta/meta/ilst`, where the title is stored in the `©nam` atom. The
+parser reads atom headers with small bounded reads and seeks over everything
+else, so fetching the title costs a few kilobytes of I/O even when the
+`moov` atom sits behind gigabytes of `mdat`.
+
+The writer replaces the `©nam` atom in place when the new title fits in the
+space taken by the old one and any `free` atoms next to it, either inside
+`ilst` or right after it. The sizes of the enclosing atoms never change and
+no media data moves, so the chunk offsets stay valid. Anything else is left
+to mutagen.
+
+MP4 file format - ISO/IEC 14496-12 and 14496-14
+'''
+
+import os
+import struct
+from collections import namedtuple
+
+# Atom types used by the parser
+MOOV = b'moov'
+UDTA = b'udta'
+META = b'meta'
+HDLR = b'hdlr'
+ILST = b'ilst'
+TITLE = b'\xa9nam'
+DATA = b'data'
+FREE_TYPES = {b'free', b'skip'}
+
+# Well-known types of the `data` atom payload
+UTF8_TYPE = 1
+UTF16_TYPE = 2
+
+# Size of a compact and of an extended atom header
+HEADER_SIZE = 8
+LARGE_HEADER_SIZE = 16
+# Upper bounds on the amount of data read while looking for the title
+MAX_TOP_LEVEL_ATOMS = 64
+MAX_CHILD_ATOMS = 1024
+MAX_ILST_SIZE = 1 << 20
+
+# Describes a parsed atom. `offset` is the position of its header, `data`
+# the position of its payload and `size` the length of the payload.
+Atom = namedtuple('Atom', ['type', 'offset', 'data', 'size'])
+
+
+class MP4Error(Exception):
+    '''Raised when a file can't be understood by the parser'''
+
+
+def read_at(file, offset, size):
+    '''Reads at most `size` bytes at `offset` of the open file `file`'''
+
+    file.seek(offset)
+    return file.read(size)
+
+
+def parse_header(buffer, pos, offset, end):
+    '''
+    Parses the atom header at `buffer[pos]`, `offset` is the file position
+    of the start of `buffer` and `end` the file position where the
+    enclosing atom ends.
+    '''
+
+    if pos + HEADER_SIZE > len(buffer):
+        raise MP4Error("Truncated atom header.")
+    size, atom_type = struct.unpack_from('>I4s', buffer, pos)
+    header_size = HEADER_SIZE
+    if size == 1:
+        if pos + LARGE_HEADER_SIZE > len(buffer):
+            raise MP4Error("Truncated atom header.")
+        size, = struct.unpack_from('>Q', buffer, pos + HEADER_SIZE)
+        header_size = LARGE_HEADER_SIZE
+    elif size == 0:
+        # The last atom may extend to the end of its parent
+        size = end - offset - pos
+    if size < header_size or offset + pos + size > end:
+        raise MP4Error("Invalid atom size.")
+    return Atom(atom_type, offset + pos, offset + pos + header_size,
+                size - header_size)
+
+
+def read_atom(file, offset, end):
+    '''Reads the header of the atom starting at `offset`, returns `None`
+    if there is no room for one before `end`'''
+
+    if offset + HEADER_SIZE > end:
+        return None
+    buffer = read_at(file, offset, min(LARGE_HEADER_SIZE, end - offset))
+    return parse_header(buffer, 0, offset, end)
+
+
+def find_child(file, parent, atom_type, limit=MAX_CHILD_ATOMS, skip=0):
+    '''
+    Returns the first child of `parent` of type `atom_type`, seeking from
+    header to header, or `None` if there is none. `skip` is the number of
+    bytes before the first child.
+    '''
+
+    end = parent.data + parent.size
+    pos = parent.data + skip
+    for _ in range(limit):
+        atom = read_atom(file, pos, end)
+        if atom is None:
+            break
+        if atom.type == atom_type:
+            return atom
+        pos = atom.data + atom.size
+    return None
+
+
+def iter_children(buffer, offset):
+    '''Yields the atoms stored back to back in `buffer`, which starts at
+    file position `offset`'''
+
+    pos = 0
+    end = offset + len(buffer)
+    while pos < len(buffer):
+        atom = parse_header(buffer, pos, offset, end)
+        yield atom
+        pos = atom.data - offset + atom.size
+
+
+def _meta_skip(file, meta):
+    '''
+    Returns the number of bytes before the first child of `meta`. The ISO
+    layout starts with a version and flags field, the QuickTime layout
+    starts with the `hdlr` atom right away.
+    '''
+
+    buffer = read_at(file, meta.data, HEADER_SIZE)
+    if len(buffer) == HEADER_SIZE and buffer[4:] == HDLR:
+        return 0
+    return 4
+
+
+def find_ilst(file):
+    '''Returns the `meta` atom of the movie and its `ilst` atom, or `None`
+    if the movie has no metadata list'''
+
+    file_size = os.fstat(file.fileno()).st_size
+    root = Atom(None, 0, 0, file_size)
+    moov = find_child(file, root, MOOV, MAX_TOP_LEVEL_ATOMS)
+    if moov is None:
+        raise MP4Error("Movie atom not found.")
+    udta = find_child(file, moov, UDTA)
+    meta = udta and find_child(file, udta, META)
+    ilst = meta and find_child(file, meta, ILST, skip=_meta_skip(file, meta))
+    return None if ilst is None else (meta, ilst)
+
+
+def read_ilst(file):
+    '''Returns the `meta` and `ilst` atoms and the payload of `ilst`, or
+    `None` if the movie has no metadata list'''
+
+    atoms = find_ilst(file)
+    if atoms is None:
+        return None
+    meta, ilst = atoms
+    if ilst.size > MAX_ILST_SIZE:
+        raise MP4Error("Metadata list too large.")
+    body = read_at(file, ilst.data, ilst.size)
+    if len(body) != ilst.size:
+        raise MP4Error("Truncated metadata list.")
+    return meta, ilst, body
+
+
+def _decode_title(buffer, atom):
+    '''Decodes the text held by the `data` atom of the `©nam` atom'''
+
+    start = atom.data - atom.offset
+    for data in iter_children(buffer[start:start + atom.size], atom.data):
+        if data.type != DATA or data.size < 8:
+            continue
+        pos = data.data - atom.offset
+        value_type, = struct.unpack_from('>I', buffer, pos)
+        value = buffer[pos + 8:pos + data.size]
+        try:
+            if value_type == UTF8_TYPE:
+                return value.decode('utf-8')
+            if value_type == UTF16_TYPE:
+                return value.decode('utf-16-be')
+        except UnicodeDecodeError:
+            raise MP4Error("Title is not valid text.")
+        raise MP4Error("Unsupported title data type.")
+    return ''
+
+
+def read_title(path):
+    '''
+    Returns the title stored in the `©nam` atom of the MP4 file at `path`,
+    or an empty string if it has none. Raises `MP4Error` if the file can't
+    be parsed.
+    '''
+
+    with open(path, 'rb') as file:
+        atoms = read_ilst(file)
+    if atoms is None:
+        return ''
+
+    _, ilst, body = atoms
+    for child in iter_children(body, ilst.data):
+        if child.type == TITLE:
+            start = child.offset - ilst.data
+            return _decode_title(
+                body[start:child.data - ilst.data + child.size], child)
+    return ''
+
+
+def encode_atom(atom_type, payload):
+    '''Encodes a complete atom with a compact header'''
+
+    return struct.pack('>I4s', HEADER_SIZE + len(payload), atom_type) + \
+        payload
+
+
+def encode_title(title):
+    '''Encodes a `©nam` atom holding `title` as UTF-8 text'''
+
+    payload = title.encode('utf-8')
+    return encode_atom(TITLE, encode_atom(
+        DATA, struct.pack('>II', UTF8_TYPE, 0) + payload))
+
+
+def _fill(atoms, length):
+    '''Pads the encoded `atoms` with a `free` atom to exactly `length`
+    bytes, returns `None` if that isn't possible'''
+
+    leftover = length - len(atoms)
+    if leftover == 0:
+        return atoms
+    if leftover < HEADER_SIZE:
+        return None
+    return atoms + encode_atom(b'free', b'\0' * (leftover - HEADER_SIZE))
+
+
+def _grow(types, index):
+    '''Returns the range of the `free` atoms around position `index`'''
+
+    first = last = index
+    while first > 0 and types[first - 1] in FREE_TYPES:
+        first -= 1
+    while last + 1 < len(types) and types[last + 1] in FREE_TYPES:
+        last += 1
+    return first, last
+
+
+def _ilst_region(children, title_atom):
+    '''
+    Returns the start and end of the `©nam` atom and the `free` atoms next
+    to it inside `ilst`, or of the first run of `free` atoms when there is
+    no title yet, along with the replacement bytes. Returns `None` if the
+    new title doesn't fit.
+    '''
+
+    types = [child.type for child in children]
+    if TITLE in types:
+        index = types.index(TITLE)
+    else:
+        index = next((index for index, atom_type in enumerate(types)
+                      if atom_type in FREE_TYPES), None)
+        if index is None:
+            return None
+    first, last = _grow(types, index)
+    start = children[first].offset
+    end = children[last].data + children[last].size
+    region = _fill(title_atom, end - start)
+    return None if region is None else (start, region)
+
+
+def _meta_region(file, meta, ilst, body, children, title_atom):
+    '''
+    Returns the start of `ilst` and the bytes of a rebuilt `ilst` followed
+    by the shrunk `free` atoms that come right after it in `meta`. Returns
+    `None` if there isn't enough room.
+    '''
+
+    # Keep every other entry, dropping the padding of the list itself
+    kept = b''.join(
+        body[child.offset - ilst.data:child.data - ilst.data + child.size]
+        for child in children
+        if child.type != TITLE and child.type not in FREE_TYPES)
+    new_ilst = encode_atom(ILST, title_atom + kept)
+
+    end = meta.data + meta.size
+    region_end = ilst.data + ilst.size
+    for _ in range(MAX_CHILD_ATOMS):
+        atom = read_atom(file, region_end, end)
+        if atom is None or atom.type not in FREE_TYPES:
+            break
+        region_end = atom.data + atom.size
+    region = _fill(new_ilst, region_end - ilst.offset)
+    return None if region is None else (ilst.offset, region)
+
+
+def write_title(path, title):
+    '''
+    Replaces the title of the MP4 file at `path` in place. Returns `False`
+    without modifying the file if the new title doesn't fit in the existing
+    `©nam` and `free` atoms. Raises `MP4Error` if the file can't be parsed.
+    '''
+
+    title_atom = encode_title(title)
+
+    with open(path, 'r+b') as file:
+        atoms = read_ilst(file)
+        # Creating the metadata list would change the size of `moov`
+        if atoms is None:
+            return False
+        meta, ilst, body = atoms
+        children = list(iter_children(body, ilst.data))
+
+        # Prefer touching only the title, then rebuild the whole list
+        change = _ilst_region(children, title_atom) or \
+            _meta_region(file, meta, ilst, body, children, title_atom)
+        if change is None:
+            return False
+        start, region = change
+
+        # Replace the whole region with a single write and make sure it
+        # reaches the disk before reporting success
+        file.seek(start)
+        file.write(region)
+        file.flush()
+        os.fsync(file.fileno())
+    return True
@@ -0,0 +1,140 @@
+'''
+Methods to plan batch jobs over many library roots in parallel.
+
+Every root, or every top level directory of a root when sharding, is planned
+by a separate worker process exactly as if the script had been run with that
+directory as its path: the `{dir}` numbering restarts in each shard and
+relative file patterns are resolved against the shard. Nothing depends on
+the working directory, so shards can run side by side. The plans of all the
+shards are merged into a single plan in the order of the roots. A batch job
+on a single path is planned in process as one shard.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from _logs import error, warning, debug
+from _stores import lazy_cache, lazy_fingerprints
+from _scanner import scan
+from _probe import VideoGroups, probe_videos
+from _pattern import PatternError, compile_patterns, apply_patterns
+from _plan import plan_record
+from _rename_plan import RenamePlan
+from _delta import plan_delta
+from _video import Video
+
+
+class Shard:
+    '''Class to describe a directory planned by a single worker'''
+
+    def __init__(self, root, recursive=True):
+
+        # Store the absolute path of the directory
+        self.root = os.path.abspath(os.path.expanduser(root))
+        # Store whether the subdirectories are part of the shard
+        self.recursive = recursive
+
+
+def make_shards(roots, split=False):
+    '''
+    Returns the shards of the given library roots. With `split`, every top
+    level directory of a root is a shard of its own and the videos directly
+    in the root form one more shard.
+    '''
+
+    shards = []
+    for root in roots:
+        root = os.path.expanduser(root)
+        if not os.path.isdir(root):
+            warning("Directory not found: " + root, "shard")
+            continue
+        if not split:
+            shards.append(Shard(root))
+            continue
+        shards.append(Shard(root, recursive=False))
+        with os.scandir(root) as iterator:
+            subdirectories = sorted(
+                entry.path for entry in iterator
+                if entry.is_dir() and not entry.name.startswith('.'))
+        shards.extend(Shard(directory) for directory in subdirectories)
+    return shards
+
+
+def plan_shard(shard, options):
+    '''
+    Plans the batch job of a single shard. `options` holds the patterns,
+    offsets and scanner settings, the offsets must already be valid.
+    Returns the status code, the plan entries of the shard and the number
+    of videos left out because they already match their plan.
+    '''
+
+    try:
+        m_template, f_template = compile_patterns(
+            options['m_pattern'], options['f_pattern'], options['regex'])
+    except PatternError as exc:
+        error(str(exc), "plan")
+        return 1, [], 0
+
+    video_groups = VideoGroups(scan(
+        shard.root, options['extensions'], options['follow_symlinks'],
+        options['hidden'], options['prune'], shard.recursive),
+        options['timeout'], shard.root)
+    video_groups.start_probing(options['workers'])
+    directory_offset, file_offset = options['offset']
+    status_code = apply_patterns(video_groups, m_template, f_template,
+                                 directory_offset, file_offset, shard.root)
+    records, skipped = [], 0
+    if status_code == 0:
+        videos = probe_videos(video_groups.videos(), options['workers'])
+        # Check the renames against every video before the ones that
+        # already match are left out
+        status_code = RenamePlan.from_videos(videos).validate()
+    if status_code == 0:
+        videos, skipped = plan_delta(videos)
+        records = [plan_record(video) for video in videos]
+    video_groups.close()
+    return status_code, records, skipped
+
+
+def _plan_worker(shard, options):
+    '''Plans a shard in a worker process, with databases of its own'''
+
+    import sqlite3
+
+    # Connections can't be shared with the parent process
+    Video.cache = lazy_cache() if options['cache'] else None
+    Video.fingerprints = lazy_fingerprints() if options['cache'] else None
+    try:
+        return plan_shard(shard, options)
+    except sqlite3.Error as exc:
+        error("Metadata cache failed: " + str(exc), "shard")
+        return 1, [], 0
+    finally:
+        if Video.cache is not None:
+            Video.cache.close()
+        if Video.fingerprints is not None:
+            Video.fingerprints.close()
+
+
+def plan_roots(shards, options, processes=None):
+    '''
+    Plans every shard on a pool of `processes` worker processes. Returns 1
+    if any shard failed and 0 otherwise, along with the merged plan entries
+    of the shards that succeeded.
+    '''
+
+    merged = []
+    status_code = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(
+            _plan_worker, shards, [options] * len(shards))
+        for shard, (shard_status, records, _) in zip(shards, results):
+            if shard_status:
+                error("Failed to plan " + shard.root, "shard")
+                status_code = 1
+                continue
+            debug("Planned {0} videos in {1}".format(
+                len(records), shard.root), "shard")
+            for record in records:
+                record['root'] = shard.root
+            merged.extend(records)
+    return status_code, merged
@@ -1,6 +1,9 @@
 '''
 Methods to correct and validate pathname.
 
+The PathValidator class caches the checks made for the target paths of a
+run so that paths sharing a directory don't repeat the same syscalls.
+
 Thanks to @CecilCurry - https://stackoverflow.com/questions/9532499/check-whether-a-path-is-valid-in-python-without-creating-a-file-at-the-paths-ta#34102855
 '''
 
@@ -91,8 +94,14 @@ def is_pathname_valid(pathname: str) -> bool:
     # (e.g., a bug). Permit this exception to unwind the call stack.
 
 
-def normalize_path(pathname):
-    '''Takes a path and tries to guess its absolute path'''
+def normalize_path(pathname, validator=None, base=None, current=None):
+    '''
+    Takes a path and tries to guess its absolute path. Relative paths are
+    resolved against `base`, or the working directory if it isn't given. A
+    `PathValidator` can be passed to reuse the checks made for earlier paths.
+    `current` is the path the file is at now, which isn't overwritten when
+    the file stays where it is.
+    '''
 
     # Expand ~ or %HOME% if present in the path
     pathname = os.path.expanduser(pathname)
@@ -100,15 +109,123 @@ def normalize_path(pathname):
     # Check if resulting path is an absolute or relative path
     # and convert if necessary
     if not os.path.isabs(pathname):
-        pathname = os.path.abspath(pathname)
+        pathname = os.path.abspath(os.path.join(base or os.getcwd(), pathname))
 
-    # Check if path already exists and raise a warning if it does
-    if os.path.exists(pathname):
+    # Check if path already exists and raise a warning if it does, unless
+    # it is the file itself
+    stays = current is not None and pathname == os.path.abspath(current)
+    if not stays and (validator.exists(pathname) if validator else
+                      os.path.exists(pathname)):
         warning("Path already exists and will be overwritten.", "path")
 
     # Check if the path is valid
     debug(pathname, "path")
-    if is_pathname_valid(pathname):
+    if validator.is_valid(pathname) if validator else \
+            is_pathname_valid(pathname):
         return pathname
     error("Illegal path encountered.", "path")
     return 1
+
+
+class PathValidator:
+    '''
+    Class to validate many target paths of a run while answering repeated
+    questions from memory. Components, directory listings and filesystem
+    limits are each looked up once, so a batch of renames into the same
+    directory costs a handful of syscalls instead of several per path.
+    '''
+
+    def __init__(self):
+
+        # Map every path component to whether it is valid
+        self._components = {}
+        # Map every directory to the set of names it holds, or None if it
+        # doesn't exist
+        self._listings = {}
+        # Map every existing directory to its NAME_MAX and PATH_MAX limits
+        self._limits = {}
+
+    def _component_valid(self, part):
+        '''Checks a single path component, see `is_pathname_valid`'''
+
+        if part not in self._components:
+            self._components[part] = is_pathname_valid(part) if part \
+                else True
+        return self._components[part]
+
+    def _listing(self, directory):
+        '''Returns the names in `directory`, or None if it doesn't exist'''
+
+        if directory not in self._listings:
+            try:
+                self._listings[directory] = set(os.listdir(directory))
+            except OSError:
+                self._listings[directory] = None
+        return self._listings[directory]
+
+    def _existing_ancestor(self, pathname):
+        '''Returns the closest existing directory above `pathname`'''
+
+        directory = os.path.dirname(pathname)
+        while self._listing(directory) is None:
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        return directory
+
+    def _path_limits(self, directory):
+        '''Returns the NAME_MAX and PATH_MAX of the filesystem holding
+        `directory`, or None where they can't be queried'''
+
+        if directory not in self._limits:
+            limits = []
+            for name in ('PC_NAME_MAX', 'PC_PATH_MAX'):
+                try:
+                    limits.append(os.pathconf(directory, name))
+                except (AttributeError, OSError, ValueError):
+                    limits.append(None)
+            self._limits[directory] = tuple(limits)
+        return self._limits[directory]
+
+    def exists(self, pathname):
+        '''Checks whether `pathname` exists using the cached listings'''
+
+        listing = self._listing(os.path.dirname(pathname))
+        return listing is not None and os.path.basename(pathname) in listing
+
+    def is_valid(self, pathname):
+        '''`True` if the absolute `pathname` is valid, `False` otherwise'''
+
+        if not isinstance(pathname, str) or not pathname or \
+                '\0' in pathname:
+            return False
+
+        _, stripped = os.path.splitdrive(pathname)
+        name_max, path_max = self._path_limits(
+            self._existing_ancestor(pathname))
+        if path_max is not None and len(os.fsencode(pathname)) >= path_max:
+            return False
+        for part in stripped.split(os.path.sep):
+            if name_max is not None and len(os.fsencode(part)) > name_max:
+                return False
+            if not self._component_valid(part):
+                return False
+        return True
+
+    def normalize_many(self, pathnames, base=None, currents=None):
+        '''
+        Normalizes and validates every path of `pathnames` in one pass,
+        resolving relative paths against `base`. `currents` are the paths
+        the files are at now, if known. Returns the list of absolute paths,
+        or 1 if any of them is invalid.
+        '''
+
+        normalized = []
+        for index, pathname in enumerate(pathnames):
+            pathname = normalize_path(pathname, self, base,
+                                      currents and currents[index])
+            if pathname == 1:
+                return 1
+            normalized.append(pathname)
+        return normalized
@@ -0,0 +1,234 @@
+'''
+Module that defines the Pattern class and its member methods.
+
+A Pattern is a metadata or file pattern parsed once into literal text and
+field lookups, so that rendering it for thousands of videos doesn't parse
+the format string again for each of them. Only the fields used by a pattern
+are computed, which keeps the title from being probed unless the pattern
+asks for it.
+
+Supported fields
+ * {dir} - directory based numbering
+ * {file} - file based numbering
+ * {stem} - current filename without its extension
+ * {parent} - name of the directory holding the video
+ * {title} - current title of the video
+ * {re[1]}, {re[name]} - groups captured by the --regex expression from
+   the current filename
+'''
+
+import os
+import re
+from string import Formatter
+from _logs import error, warning, debug
+from _normalize_path import PathValidator
+
+# Names of the fields that can be used in a pattern
+FIELDS = {'dir', 'file', 'stem', 'parent', 'title', 're'}
+
+# Conversions supported after a `!` in a replacement field
+CONVERSIONS = {'s': str, 'r': repr, 'a': ascii}
+
+# Attribute and index lookups following the name of a replacement field
+LOOKUP = re.compile(r'\.([^.[]+)|\[([^\]]+)\]')
+
+
+class PatternError(ValueError):
+    '''Raised when a pattern can't be parsed or rendered'''
+
+
+def _split_field_name(name):
+    '''Splits a field name such as `re[1]` into its first name and the list
+    of `(is_attribute, key)` lookups applied to it, like str.format'''
+
+    first = re.match(r'[^.[]*', name).group()
+    rest = []
+    position = len(first)
+    while position < len(name):
+        match = LOOKUP.match(name, position)
+        if match is None:
+            raise PatternError("Invalid field {" + name + "}.")
+        attribute, key = match.groups()
+        if attribute is not None:
+            rest.append((True, attribute))
+        else:
+            rest.append((False, int(key) if key.isdigit() else key))
+        position = match.end()
+    return first, rest
+
+
+class Pattern:
+    '''Class to render a metadata or file pattern for many videos'''
+
+    def __init__(self, pattern, regex=None):
+
+        # Store the pattern as entered by the user
+        self.pattern = pattern
+        # Store the expression matched against the current filenames
+        try:
+            self.regex = re.compile(regex) if regex else None
+        except re.error as exc:
+            raise PatternError("Invalid regex: " + str(exc))
+        # Store the names of the fields used by the pattern
+        self.fields = set()
+        # Store the parsed pattern as literals and field lookups
+        self._parts = self._compile(pattern)
+
+        if 're' in self.fields and self.regex is None:
+            raise PatternError("The {re} field requires a regex.")
+
+    def _compile(self, pattern):
+        '''Parses `pattern` into a list of literals and field lookups'''
+
+        parts = []
+        try:
+            for literal, name, spec, conversion in Formatter().parse(pattern):
+                if literal:
+                    parts.append(literal)
+                if name is None:
+                    continue
+                if not name or name.isdigit():
+                    raise PatternError("Positional fields are not supported.")
+                first, rest = _split_field_name(name)
+                if first not in FIELDS:
+                    raise PatternError("Unknown field {" + first + "}.")
+                if conversion is not None and conversion not in CONVERSIONS:
+                    raise PatternError("Unknown conversion !" + conversion)
+                self.fields.add(first)
+                # Nested fields in the format spec are rendered first
+                spec = self._compile(spec) if '{' in spec else spec
+                parts.append((first, rest, spec, conversion))
+        except ValueError as exc:
+            raise PatternError(str(exc))
+        return parts
+
+    @property
+    def uses_title(self):
+        '''Checks whether rendering the pattern needs the current title'''
+
+        return 'title' in self.fields
+
+    def _fields(self, video, directory, file):
+        '''Returns the values of the fields used by the pattern'''
+
+        fields = {'dir': directory, 'file': file}
+        if 'stem' in self.fields:
+            fields['stem'] = os.path.splitext(video.current_filename)[0]
+        if 'parent' in self.fields:
+            fields['parent'] = os.path.basename(
+                os.path.dirname(video.current_path))
+        if 'title' in self.fields:
+            fields['title'] = video.current_metadata_title
+        if 're' in self.fields:
+            fields['re'] = self._captures(video.current_filename)
+        return fields
+
+    def _captures(self, filename):
+        '''Returns the groups captured from `filename` by number and name'''
+
+        match = self.regex.search(filename)
+        if match is None:
+            warning("Regex doesn't match " + filename, "pattern")
+            return {}
+        captures = {index: group for index, group in enumerate(
+            (match.group(0),) + match.groups())}
+        captures.update(match.groupdict())
+        return captures
+
+    def _render(self, parts, fields):
+        '''Renders the compiled `parts` with the values in `fields`'''
+
+        rendered = []
+        for part in parts:
+            if isinstance(part, str):
+                rendered.append(part)
+                continue
+            first, rest, spec, conversion = part
+            value = fields[first]
+            for is_attribute, key in rest:
+                value = getattr(value, key) if is_attribute else value[key]
+            if conversion is not None:
+                value = CONVERSIONS[conversion](value)
+            if not isinstance(spec, str):
+                spec = self._render(spec, fields)
+            rendered.append(format(value, spec))
+        return ''.join(rendered)
+
+    def render(self, video, directory, file):
+        '''Renders the pattern for `video` with the given numbering'''
+
+        try:
+            return self._render(
+                self._parts, self._fields(video, directory, file))
+        except (KeyError, IndexError, AttributeError, TypeError,
+                ValueError) as exc:
+            raise PatternError("Failed to render {0!r} for {1}: {2}".format(
+                self.pattern, video.current_filename, exc))
+
+    def render_directory(self, videos, directory, first_file):
+        '''
+        Renders the pattern for every video of a directory run, numbering
+        the files from `first_file`.
+        '''
+
+        return [self.render(video, directory, file)
+                for file, video in enumerate(videos, first_file)]
+
+
+def compile_patterns(m_pattern, f_pattern, regex=None):
+    '''
+    Compiles a metadata and a file pattern, a pattern of \\ is returned as
+    `None` to leave the field untouched. Raises `PatternError`.
+    '''
+
+    m_template = Pattern(m_pattern, regex) if m_pattern != "\\" else None
+    f_template = Pattern(f_pattern, regex) if f_pattern != "\\" else None
+    return m_template, f_template
+
+
+def apply_patterns(video_groups, m_template, f_template, directory_offset,
+                   file_offset, base=None):
+    '''
+    Sets the new title and path of every video in the directory runs of
+    `video_groups`. The directory number starts at `directory_offset` and
+    grows with each run, the file number starts at `file_offset` and
+    restarts at 1 in every run after the first. Relative target paths are
+    resolved against `base`, or the working directory if it isn't given.
+    Returns 1 if a pattern can't be rendered or a path is invalid, 0
+    otherwise.
+    '''
+
+    # Validate the target paths of this pass with shared lookups
+    validator = PathValidator()
+
+    for group_number, videos in enumerate(video_groups):
+        # Increment directory offset and reset file offset when
+        # the directory of the previous video doesn't match the current
+        if group_number:
+            directory_offset += 1
+            file_offset = 1
+            debug(os.path.dirname(videos[0].current_path), "run")
+        try:
+            titles = m_template.render_directory(
+                videos, directory_offset, file_offset) \
+                if m_template else None
+            paths = validator.normalize_many(
+                f_template.render_directory(
+                    videos, directory_offset, file_offset), base,
+                [video.current_path for video in videos]) \
+                if f_template else None
+        except PatternError as exc:
+            error(str(exc), "run")
+            return 1
+        # Return if a path is invalid
+        if paths == 1:
+            return 1
+        file_offset += len(videos)
+
+        for index, video in enumerate(videos):
+            if titles:
+                video.set_metadata_title = titles[index]
+            if paths:
+                video.set_path = paths[index]
+                video.set_filename = os.path.basename(video.set_path)
+    return 0
@@ -0,0 +1,147 @@
+'''
+Methods to write and apply machine readable edit plans.
+
+A plan is a JSON lines file with one object per video holding its current
+path and title and the path and title it should end up with. Plans are
+written by a headless batch run and applied later, possibly on another host,
+without probing the files again. Applying a plan streams one JSON object per
+completed step with its status code and latency.
+'''
+
+import json
+import os
+from _logs import debug
+from _apply import ApplyEngine
+from _probe import create_video
+from _rename_plan import RenamePlan
+
+
+def plan_record(video):
+    '''Returns the plan entry of a video'''
+
+    return {
+        'path': video.current_path,
+        'title': video.current_metadata_title,
+        'target_path': video.set_path,
+        'target_title': video.set_metadata_title,
+    }
+
+
+def write_plan(videos, stream):
+    '''Writes the plan entry of every video in `videos` to `stream`,
+    entries that are already plan records are written as they are'''
+
+    for video in videos:
+        record = video if isinstance(video, dict) else plan_record(video)
+        stream.write(json.dumps(record) + '\n')
+    stream.flush()
+
+
+def read_plan(stream):
+    '''Returns the entries of the plan read from `stream`'''
+
+    records = []
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict) or 'path' not in record:
+            raise ValueError("Invalid plan entry on line {0}.".format(
+                line_number))
+        records.append(record)
+    return records
+
+
+def videos_from_plan(records, timeout=None):
+    '''Creates the video objects described by the plan entries, using the
+    recorded titles instead of probing the files'''
+
+    videos = []
+    for record in records:
+        # Subtitle files are moved by the rename plan only
+        if record.get('sidecar'):
+            continue
+        video = create_video(record['path'], timeout)
+        if video is None:
+            continue
+        videos.append(video)
+        if record.get('title') is not None:
+            video.current_metadata_title = record['title']
+        target_title = record.get('target_title')
+        if target_title is not None and target_title != record.get('title'):
+            video.set_metadata_title = target_title
+        if record.get('target_path'):
+            video.set_path = record['target_path']
+            video.set_filename = os.path.basename(video.set_path)
+    return videos
+
+
+def _emit(stream, video_path, stage, status_code, elapsed):
+    '''Writes the result of a single step'''
+
+    stream.write(json.dumps({
+        'path': video_path,
+        'stage': stage,
+        'status': status_code,
+        'latency_ms': round(elapsed * 1000, 3),
+    }) + '\n')
+    stream.flush()
+
+
+def apply_plan(records, stream, workers=None, device_limit=None,
+               timeout=None, journal_path=None, journal_state=None,
+               sidecars=True):
+    '''
+    Applies the plan entries `records` and streams the result of every
+    step to `stream`. Returns 1 if the plan couldn't be applied completely
+    and 0 otherwise. The progress is recorded in a journal at
+    `journal_path` if one is given, continuing the batch described by
+    `journal_state` when the entries resume an earlier one. The subtitle
+    files of the renamed videos are moved along with them if `sidecars`
+    is set.
+    '''
+
+    # Writing a plan needs neither the journal nor the subtitle files
+    from _journal import open_journal, journal_record, sidecar_record
+    from _sidecars import attach_sidecars
+
+    videos = videos_from_plan(records, timeout)
+    renames = RenamePlan.from_videos(videos)
+    for record in records:
+        if record.get('sidecar'):
+            renames.add(record['path'], record['target_path'])
+    if sidecars:
+        attach_sidecars(renames)
+    if renames.validate():
+        return 1
+
+    engine = ApplyEngine(workers, device_limit)
+    changed = [video for video in videos if video.title_changed()]
+    debug("Applying {0} titles and {1} renames.".format(
+        len(changed), len(renames.moves)), "plan")
+    if journal_state is not None:
+        entries = list(journal_state.entries.values())
+    else:
+        entries = [journal_record(video) for video in videos] + \
+            [sidecar_record(move) for move in renames.moves
+             if move.video is None]
+    journal = journal_path and open_journal(
+        journal_path, entries, journal_state)
+
+    def report(video, status_code, elapsed):
+        if journal is not None:
+            journal.titled(video, status_code)
+        _emit(stream, video.current_path, 'metadata', status_code, elapsed)
+
+    if engine.apply_metadata(changed, report) or renames.execute(
+            lambda move, elapsed: _emit(
+                stream, move.origin, 'rename', 0, elapsed),
+            journal and journal.moved, journal and journal.moving):
+        if journal is not None:
+            journal.close()
+        return 1
+
+    if journal is not None:
+        journal.commit()
+    return 0
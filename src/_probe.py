@@ -0,0 +1,224 @@
+'''
+Methods to probe the metadata of many video files concurrently.
+
+Every video object fetches its title through an external process, which is
+dominated by process startup rather than disk reads. Running the probes on a
+bounded pool of worker threads lets several of them wait on their
+subprocesses at the same time while the results are still returned in the
+order of the input list.
+
+Video objects are created after reading only the first bytes of the file,
+which pick the backend of its container. Titles are either probed for a
+whole list at once with `probe_videos`, one batch per backend, or fetched a
+few files ahead of the user with a `Prefetcher`. `VideoGroups` turns the
+directory runs of the scanner into video objects as the walk progresses,
+stored in a `VideoTable` to keep large trees small.
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from _logs import warning, debug, metrics
+from _backends import backend_for, group_by_backend
+from _table import VideoTable
+
+# Upper bound on the number of probes that are allowed to run at once
+MAX_WORKERS = 32
+
+
+def default_workers():
+    '''Returns the default number of probe workers for this machine'''
+
+    return min(MAX_WORKERS, (os.cpu_count() or 1) * 2)
+
+
+def create_video(path, timeout=None, table=None):
+    '''
+    Instantiates the video object of the backend handling `path`, or returns
+    `None` if its container isn't supported. `timeout` is the number of
+    seconds after which probing the file is abandoned. If a `VideoTable` is
+    given, the video is stored in it and a view of its row is returned.
+    '''
+
+    video_class = backend_for(path)
+    if video_class is None:
+        warning("Unsupported container, skipping " + path, "probe")
+        return None
+    if table is not None:
+        return table.add(path, video_class)
+    return video_class(path, timeout)
+
+
+def create_videos(video_list, timeout=None, table=None):
+    '''Instantiates a video object for every supported path in
+    `video_list`'''
+
+    videos = []
+    for path in video_list:
+        video = create_video(path, timeout, table)
+        if video is not None:
+            videos.append(video)
+    return videos
+
+
+def probe_videos(videos, workers=None):
+    '''
+    Fetches the title of every video in `videos`, letting the backend of
+    each container probe its own videos with up to `workers` at once, and
+    returns the list once all of them are known.
+    '''
+
+    workers = workers or default_workers()
+    debug("Probing %d videos with %d workers.", "probe", len(videos), workers)
+    metrics.count('files.probe', len(videos))
+
+    with metrics.timer('phase.probe'):
+        for video_class, group in group_by_backend(videos).items():
+            video_class.probe_many(group, workers)
+    return videos
+
+
+class Prefetcher:
+    '''Class to fetch the titles of the next few videos in the background
+    while the user is editing the current one'''
+
+    def __init__(self, videos, count, workers=None):
+
+        # Store the videos in the order in which they are shown
+        self.videos = videos
+        # Store the number of videos to fetch ahead of the current one
+        self.count = count
+        self.executor = ThreadPoolExecutor(
+            max_workers=min(workers or default_workers(), max(count, 1)))
+
+    def advance(self, index):
+        '''Schedules the titles of the videos following `index`'''
+
+        for video in self.videos[index + 1:index + 1 + self.count]:
+            video.prefetch(self.executor)
+
+    def close(self):
+        '''Discards the pending fetches and stops the worker threads'''
+
+        for video in self.videos:
+            video.cancel_prefetch()
+        self.executor.shutdown(wait=False)
+
+
+class VideoGroups:
+    '''Class to create the video objects of each directory run found by
+    the scanner and keep them for the following passes'''
+
+    def __init__(self, batches, timeout=None, base=None, compact=True):
+
+        # Store the scanner output that hasn't been consumed yet
+        self._batches = iter(batches)
+        # Store the videos in shared columns unless separate objects are
+        # asked for
+        self.table = VideoTable(timeout) if compact else None
+        # Store the directory the scanned paths are relative to
+        self.base = base
+        # Store the videos created so far, as ranges of table rows or as
+        # lists of video objects
+        self._groups = []
+        self.timeout = timeout
+        # Store the pool or asyncio pipeline that probes the new videos,
+        # if any
+        self._executor = None
+        self._pipeline = None
+        # Store whether the scanner is exhausted
+        self.complete = False
+
+    def __iter__(self):
+        # Replay the groups of the earlier passes before scanning further
+        index = 0
+        while True:
+            if index == len(self._groups) and not self._next_group():
+                return
+            yield self._videos_of(self._groups[index])
+            index += 1
+
+    def _videos_of(self, group):
+        '''Returns the videos of a stored group'''
+
+        if self.table is None:
+            return group
+        # The views are created again on every pass, only the table
+        # outlives them
+        return [self.table.view(row) for row in group]
+
+    def _next_group(self):
+        '''Creates the videos of the next run, returns `False` once the
+        scanner is exhausted'''
+
+        batch = next(self._batches, None)
+        if batch is None:
+            self.complete = True
+            return False
+        directory, files = batch
+        debug("Scanned %s", "probe", directory or ".")
+        metrics.count('files.scan', len(files))
+        start = len(self.table) if self.table is not None else 0
+        group = create_videos(
+            [os.path.join(self.base or os.getcwd(), file) for file in files],
+            self.timeout, self.table)
+        if self._executor is not None or self._pipeline is not None:
+            self._prefetch(group)
+        self._groups.append(group if self.table is None
+                            else range(start, len(self.table)))
+        return True
+
+    def start_probing(self, workers=None, pipeline=None):
+        '''Probes every video created so far and from now on in the
+        background, so that probing overlaps the rest of the scan. The
+        probes run on `pipeline` if an `AsyncPipeline` is given.'''
+
+        if pipeline is not None:
+            self._pipeline = pipeline
+        elif self._executor is None and self._pipeline is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers or default_workers())
+        for group in self._groups:
+            self._prefetch(self._videos_of(group))
+
+    def _prefetch(self, group):
+        '''Schedules the titles of a group in batches per backend'''
+
+        if self._pipeline is not None:
+            self._pipeline.prefetch(group)
+            return
+        for video_class, videos in group_by_backend(group).items():
+            video_class.prefetch_many(videos, self._executor)
+
+    def close(self):
+        '''Discards the pending probes and stops the worker threads'''
+
+        if self._executor is not None or self._pipeline is not None:
+            for group in self._groups:
+                for video in self._videos_of(group):
+                    video.cancel_prefetch()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        # The pipeline belongs to the caller
+        self._pipeline = None
+
+    def total(self):
+        '''Returns the number of videos of the tree once the scan is
+        complete, `None` before'''
+
+        if not self.complete:
+            return None
+        return sum(len(group) for group in self._groups)
+
+    def iter_videos(self):
+        '''Yields the videos of the tree one at a time, scanning further
+        only when the videos found so far are used up'''
+
+        for group in self:
+            for video in group:
+                yield video
+
+    def videos(self):
+        '''Returns every video of the tree, finishing the scan'''
+
+        return [video for group in self for video in group]
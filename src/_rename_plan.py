@@ -0,0 +1,234 @@
+'''
+Module that defines the RenamePlan class and its member methods.
+
+The RenamePlan class collects every rename of a batch before any of them is
+made. This makes it possible to refuse batches in which two files would end
+up at the same path, and to order the moves so that a file is never renamed
+onto another file of the same batch that hasn't moved out of the way yet.
+Moves that form a cycle (e.g. swapping two episode numbers) are broken up by
+moving one of the files to a temporary name first.
+'''
+
+import os
+import time
+from collections import deque
+from _logs import error, warning, debug, metrics
+
+
+class Move:
+    '''Class to describe a single planned rename'''
+
+    def __init__(self, source, target, video=None):
+
+        # Store the absolute current and planned path of the file
+        self.source = os.path.abspath(source)
+        self.target = os.path.abspath(target)
+        # Store the path the file had before the plan ran
+        self.origin = self.source
+        # Store the video object to update once the file has moved
+        self.video = video
+
+
+class RenamePlan:
+    '''Class to check and execute the renames of a batch in one pass'''
+
+    def __init__(self):
+
+        # Store the planned moves in the order in which they were added
+        self.moves = []
+        # Store the paths of the files of the batch that stay where they are
+        self.stationary = set()
+
+    @classmethod
+    def from_videos(cls, videos):
+        '''Builds the plan for every video whose path has been changed'''
+
+        plan = cls()
+        for video in videos:
+            plan.add(video.current_path, video.set_path, video)
+        return plan
+
+    def add(self, source, target, video=None):
+        '''Queues the rename of `source` to `target`'''
+
+        move = Move(source, target, video)
+        if move.source != move.target:
+            self.moves.append(move)
+            return
+        # The file still occupies its path, which no other file may take
+        self.stationary.add(move.source)
+        if video is not None:
+            # Keep the object consistent even if nothing has to move
+            video.current_filename = video.set_filename
+
+    def validate(self, overwrite=True):
+        '''
+        Checks the plan for collisions. Returns 1 if two files would be
+        moved to the same path, a file would be moved onto a file of the
+        batch that stays where it is or onto a copy of the same video, 0
+        otherwise. Other existing files outside of the batch that would be
+        overwritten only cause a warning, unless `overwrite` is unset, in
+        which case they are refused as well.
+        '''
+
+        targets = {}
+        sources = {move.source for move in self.moves}
+        status_code = 0
+        for move in self.moves:
+            if move.target in targets:
+                error("Two files would be renamed to the same path.", "plan")
+                error(targets[move.target] + ", " + move.source, "plan")
+                status_code = 1
+            targets[move.target] = move.source
+            if move.target in self.stationary:
+                error("A file would be renamed onto a file of the batch "
+                      "that keeps its path.", "plan")
+                error(move.source + ", " + move.target, "plan")
+                status_code = 1
+                continue
+
+            # Files of the batch are moved out of the way before they are
+            # overwritten, the only exception being the file itself on a
+            # case insensitive filesystem
+            if move.target not in sources and os.path.lexists(move.target) \
+                    and not _same_file(move.source, move.target):
+                from _fingerprint import same_content
+                # Replacing a duplicate would silently merge the two copies
+                if same_content(move.source, move.target):
+                    error("Path already holds a copy of the same video.",
+                          "plan")
+                    error(move.source + ", " + move.target, "plan")
+                    status_code = 1
+                elif not overwrite:
+                    error("Path already exists and won't be overwritten.",
+                          "plan")
+                    error(move.target, "plan")
+                    status_code = 1
+                else:
+                    warning("Path already exists and will be overwritten.",
+                            "plan")
+                    warning(move.target, "plan")
+        return status_code
+
+    def _ordered(self):
+        '''
+        Yields the moves in an order in which no move overwrites the source
+        of a pending move, paired with the move they complete. Cycles are
+        broken by first moving one of their files to a temporary name, which
+        is yielded without a completed move.
+        '''
+
+        by_source = {move.source: move for move in self.moves}
+        # Map every target to the move that waits for it to be emptied
+        waiting = {move.target: move for move in self.moves}
+        # A move is blocked while its target is the source of a pending move
+        pending = set(by_source)
+        ready = deque(sorted(
+            (move for move in self.moves if move.target not in pending),
+            key=lambda move: (os.path.dirname(move.target), move.target)))
+        remaining = len(self.moves)
+
+        while remaining:
+            if ready:
+                move = ready.popleft()
+                freed = move.source
+                yield move, move
+                remaining -= 1
+            else:
+                # Only cycles are left, park one of their files elsewhere
+                freed = min(pending)
+                move = by_source[freed]
+                move.source = os.path.join(
+                    os.path.dirname(freed),
+                    '.vidrenamer-' + os.urandom(16).hex())
+                metrics.count('rename.parked')
+                yield Move(freed, move.source), None
+
+            pending.discard(freed)
+            # The move waiting for the freed path can now run
+            if freed in waiting:
+                ready.append(waiting[freed])
+
+    def execute(self, report=None, step=None, intent=None):
+        '''
+        Executes the plan, returns 1 if a rename failed and 0 otherwise.
+        The plan must have passed `validate` first. `report` is called with
+        every completed move and the number of seconds it took, `step` with
+        the old and new path of every rename made, including the moves to
+        temporary names, and `intent` with the same paths right before the
+        rename is made.
+        '''
+
+        with metrics.timer('phase.rename'):
+            return self._execute(report, step, intent)
+
+    def _execute(self, report, step_done, intent):
+        '''Executes the plan, see `execute`'''
+
+        # Create every missing target directory once up front
+        created = set()
+        for move in self.moves:
+            directory = os.path.dirname(move.target)
+            if directory not in created:
+                created.add(directory)
+                try:
+                    os.makedirs(directory, exist_ok=True)
+                except OSError:
+                    error("Failed to create the directory", "plan")
+                    error(directory, "plan")
+                    return 1
+
+        emptied = set()
+        for step, move in self._ordered():
+            if intent is not None:
+                intent(step.source, step.target)
+            start = time.perf_counter()
+            try:
+                _replace(step.source, step.target)
+            except OSError:
+                error("Failed to rename the file", "plan")
+                error(step.source, "plan")
+                return 1
+            metrics.observe('rename', start, time.perf_counter() - start)
+            emptied.add(os.path.dirname(step.source))
+            if step_done is not None:
+                step_done(step.source, step.target)
+
+            if move is not None:
+                if move.video is not None:
+                    move.video.current_path = move.video.set_path
+                    move.video.current_filename = move.video.set_filename
+                metrics.count('rename.files')
+                debug("Renamed video - %s", "run", move.target)
+                if report is not None:
+                    report(move, time.perf_counter() - start)
+
+        # Prune the directories left empty, like os.renames does
+        for directory in sorted(emptied, reverse=True):
+            try:
+                os.removedirs(directory)
+            except OSError:
+                pass
+        return 0
+
+
+def _same_file(first, second):
+    '''Checks whether two paths point to the same file'''
+
+    try:
+        return os.path.samefile(first, second)
+    except OSError:
+        return False
+
+
+def _replace(source, target):
+    '''Moves `source` to `target`, copying it across devices if needed'''
+
+    try:
+        os.replace(source, target)
+    except OSError as exc:
+        if not os.path.exists(source) or os.path.isdir(target):
+            raise exc
+        # Moves across devices are rare enough to load shutil on demand
+        import shutil
+        shutil.move(source, target)
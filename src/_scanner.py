@@ -0,0 +1,109 @@
+'''
+Streaming directory scanner to find video files.
+
+The scanner walks a directory tree with `os.scandir` and yields the video
+files it finds one directory at a time, so that the caller can start working
+on the first directory before the walk is over. Files are produced in the
+same order as a sorted recursive glob, where a directory can be split in
+several consecutive runs when its subdirectories sort between its files.
+'''
+
+import os
+from fnmatch import fnmatch
+from _logs import warning, debug
+
+# File extensions of each supported container
+EXTENSION_SETS = {
+    'mkv': ('.mkv',),
+    'mp4': ('.mp4', '.m4v'),
+    'avi': ('.avi',),
+}
+
+
+def extensions_for(types):
+    '''Returns the file extensions of the container names in `types`'''
+
+    extensions = set()
+    for name in types:
+        extensions.update(EXTENSION_SETS[name])
+    return extensions
+
+
+def _sort_key(entry, is_dir):
+    '''
+    Sorts directory entries like the full paths below them would sort. A
+    trailing separator places a directory exactly where its files fall.
+    '''
+
+    return entry.name + '/' if is_dir else entry.name
+
+
+def _is_dir(entry, follow_symlinks):
+    '''Checks whether `entry` should be descended into'''
+
+    try:
+        return entry.is_dir(follow_symlinks=follow_symlinks)
+    except OSError:
+        return False
+
+
+def scan(root, extensions=('.mkv',), follow_symlinks=True,
+         include_hidden=False, prune=(), recursive=True):
+    '''
+    Walks `root` and yields `(directory, files)` tuples, where `files` is a
+    run of consecutive video paths relative to `root` that share the
+    relative `directory`.
+
+    `extensions` is the set of lower case file extensions to keep,
+    `follow_symlinks` controls whether symlinked directories are walked,
+    `include_hidden` whether names starting with a dot are considered,
+    `prune` is a list of glob patterns of directory names to skip and
+    `recursive` whether the subdirectories of `root` are walked at all.
+    '''
+
+    extensions = tuple(extension.lower() for extension in extensions)
+    # Store the directories on the current branch to avoid symlink loops
+    ancestors = set()
+
+    def walk(directory):
+        path = os.path.join(root, directory) if directory else root
+        try:
+            stat = os.stat(path)
+            with os.scandir(path) as iterator:
+                entries = [
+                    (entry, _is_dir(entry, follow_symlinks))
+                    for entry in iterator
+                    if include_hidden or not entry.name.startswith('.')
+                ]
+        except OSError as exc:
+            warning("Failed to read directory: " + str(exc), "scan")
+            return
+
+        key = (stat.st_dev, stat.st_ino)
+        if key in ancestors:
+            debug("Skipping directory loop " + path, "scan")
+            return
+        ancestors.add(key)
+
+        entries.sort(key=lambda item: _sort_key(*item))
+        run = []
+        for entry, is_dir in entries:
+            relative = os.path.join(directory, entry.name) \
+                if directory else entry.name
+            if is_dir:
+                if not recursive or \
+                        any(fnmatch(entry.name, pattern) for pattern in prune):
+                    continue
+                # Files after a subdirectory start a new run
+                if run:
+                    yield directory, run
+                    run = []
+                yield from walk(relative)
+            elif entry.name.lower().endswith(extensions):
+                run.append(relative)
+        if run:
+            yield directory, run
+
+        ancestors.discard(key)
+
+    yield from walk('')
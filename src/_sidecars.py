@@ -0,0 +1,112 @@
+'''
+Methods to move the subtitle files next to a video along with it.
+
+A subtitle file belongs to a video when its name starts with the name of
+the video without its extension, followed by a dot, such as `foo.srt`,
+`foo.en.srt` or `foo.forced.ass` for `foo.mkv`. When another video in the
+same directory has a longer matching name, the subtitles belong to that one,
+so that `foo.bar.srt` stays with `foo.bar.mkv` rather than `foo.mkv`.
+
+The SidecarIndex class lists every directory once and maps the name of each
+video to its subtitle files, so that finding the subtitles of a whole season
+costs a single directory listing rather than a glob per video.
+'''
+
+import os
+from _logs import debug, metrics
+from _scanner import EXTENSION_SETS
+
+# File extensions of the subtitle files moved along with their video
+SUBTITLE_EXTENSIONS = {'.srt', '.ass', '.ssa', '.sub', '.idx', '.vtt', '.sup',
+                       '.smi'}
+# File extensions of every container, whose files can own subtitles
+VIDEO_EXTENSIONS = {extension for extensions in EXTENSION_SETS.values()
+                    for extension in extensions}
+
+
+def _owner(name, stems):
+    '''Returns the longest name in `stems` that `name` starts with,
+    followed by a dot, or `None`'''
+
+    end = name.rfind('.')
+    while end > 0:
+        if name[:end] in stems:
+            return name[:end]
+        end = name.rfind('.', 0, end)
+    return None
+
+
+class SidecarIndex:
+    '''Class to find the subtitle files of videos, listing every directory
+    only once'''
+
+    def __init__(self, extensions=SUBTITLE_EXTENSIONS):
+
+        # Store the file extensions of the subtitle files
+        self.extensions = extensions
+        # Map every directory listed so far to the subtitle files of each
+        # video name in it
+        self._directories = {}
+
+    def _index(self, directory):
+        '''Maps the name of every video in `directory` to its subtitles'''
+
+        metrics.count('sidecars.scandir')
+        stems = set()
+        subtitles = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    stem, extension = os.path.splitext(entry.name)
+                    extension = extension.lower()
+                    if extension in VIDEO_EXTENSIONS:
+                        stems.add(stem)
+                    elif extension in self.extensions and \
+                            entry.is_file(follow_symlinks=False):
+                        subtitles.append(entry.name)
+        except OSError as exc:
+            debug("Failed to list %s: %s", "sidecars", directory, exc)
+
+        index = {}
+        for name in sorted(subtitles):
+            stem = _owner(name, stems)
+            if stem is not None:
+                index.setdefault(stem, []).append(name)
+        return index
+
+    def sidecars(self, path):
+        '''Returns the paths of the subtitle files of the video at `path`'''
+
+        directory, name = os.path.split(path)
+        if directory not in self._directories:
+            self._directories[directory] = self._index(directory)
+        return [os.path.join(directory, subtitle) for subtitle in
+                self._directories[directory].get(
+                    os.path.splitext(name)[0], ())]
+
+
+def attach_sidecars(plan, index=None):
+    '''
+    Adds the moves of the subtitle files of every video moved by the
+    RenamePlan `plan`, so that they are renamed in the same pass. Returns
+    the number of subtitle files added.
+    '''
+
+    index = index or SidecarIndex()
+    sources = {move.source for move in plan.moves}
+    count = 0
+    for move in list(plan.moves):
+        if move.video is None:
+            continue
+        stem = os.path.splitext(os.path.basename(move.source))[0]
+        target = os.path.splitext(move.target)[0]
+        for sidecar in index.sidecars(move.source):
+            # Subtitle files already in the plan keep their own target
+            if sidecar in sources:
+                continue
+            sources.add(sidecar)
+            plan.add(sidecar, target + os.path.basename(sidecar)[len(stem):])
+            count += 1
+    metrics.count('sidecars.files', count)
+    debug("Moving %d subtitle files with their videos", "sidecars", count)
+    return count
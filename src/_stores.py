@@ -0,0 +1,87 @@
+'''
+Databases of the cache directory opened on first use.
+
+Opening the metadata cache or the fingerprint index imports sqlite3, sets
+the database up for write-ahead logging and creates its schema, and closing
+it counts the entries to evict the oldest ones. Runs that never look up or
+write a title, such as a rollback, a watch session that sees no new files or
+a batch job on an empty directory, would pay for all of it on every launch.
+
+The LazyStore class stands in for such a database. Its module is imported
+and the database is opened the first time a title is looked up or stored,
+and it is only closed if it was opened. A database that can't be opened
+turns every lookup into a miss, the same as a disabled one.
+
+The location of the cache directory is kept here as well, so that the
+journals can be found without importing sqlite3.
+'''
+
+import os
+import threading
+from importlib import import_module
+
+
+def default_cache_path():
+    '''Returns the path of the cache database in the XDG cache directory'''
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'vidrenamer', 'metadata.sqlite3')
+
+
+class LazyStore:
+    '''Class to open a database of the cache directory on first use'''
+
+    def __init__(self, module, opener):
+
+        # Store the module and the name of the function opening the
+        # database
+        self.module = module
+        self.opener = opener
+        # Store the database once it is opened, None if it failed to open
+        self._store = None
+        self._opened = False
+        # The worker threads of a run may all need the database at once
+        self._lock = threading.Lock()
+
+    def _open(self):
+        '''Returns the database, opening it the first time it is needed'''
+
+        if not self._opened:
+            with self._lock:
+                if not self._opened:
+                    self._store = getattr(import_module(self.module),
+                                          self.opener)()
+                    self._opened = True
+        return self._store
+
+    def get(self, *args):
+        '''Looks up an entry, see the `get` method of the database'''
+
+        store = self._open()
+        return None if store is None else store.get(*args)
+
+    def put(self, *args):
+        '''Stores an entry, see the `put` method of the database'''
+
+        store = self._open()
+        if store is not None:
+            store.put(*args)
+
+    def close(self):
+        '''Closes the database if it was opened'''
+
+        if self._store is not None:
+            self._store.close()
+
+
+def lazy_cache():
+    '''Returns the metadata cache, opened on first use'''
+
+    return LazyStore('_cache', 'open_cache')
+
+
+def lazy_fingerprints():
+    '''Returns the fingerprint index, opened on first use'''
+
+    return LazyStore('_fingerprint', 'open_fingerprints')
@@ -0,0 +1,203 @@
+'''
+Module that defines the VideoTable class and the row views of its videos.
+
+A tree of a few hundred thousand videos holds as many video objects, each
+with its own attribute dictionary and separate strings for the current and
+new path, filename and title. The VideoTable class keeps the videos of a
+scan in shared columns instead. Every directory is stored once and referred
+to by number, the filenames and titles are kept in flat lists, and the
+values set by the user are only stored for the videos where they differ
+from the current ones.
+
+The rows are handed out as views, which are instances of a subclass of the
+container class with the same attributes and methods as a standalone video
+object. The video classes declare `__slots__` and the views only add the
+table and the row number, so they have no attribute dictionary of their own
+and are cheap to create and collect. Assigning any attribute other than the
+fields of a video to a view fails instead of being lost with the view.
+'''
+
+import os
+from array import array
+
+# Map every video class to the class of its row views
+_ROW_CLASSES = {}
+
+
+class TableRow:
+    '''Mixin that stores the fields of a video in a row of a VideoTable'''
+
+    __slots__ = ()
+
+    @property
+    def timeout(self):
+        return self._table.timeout
+
+    @property
+    def current_path(self):
+        return self._table.path(self._row)
+
+    @current_path.setter
+    def current_path(self, path):
+        self._table.move(self._row, path)
+
+    @property
+    def current_filename(self):
+        return self._table.basenames[self._row]
+
+    @current_filename.setter
+    def current_filename(self, filename):
+        self._table.basenames[self._row] = filename
+
+    @property
+    def set_path(self):
+        path = self._table.set_paths.get(self._row)
+        return self.current_path if path is None else path
+
+    @set_path.setter
+    def set_path(self, path):
+        self._table.set_delta(self._table.set_paths, self._row, path,
+                              self.current_path)
+
+    @property
+    def set_filename(self):
+        filename = self._table.set_filenames.get(self._row)
+        return self.current_filename if filename is None else filename
+
+    @set_filename.setter
+    def set_filename(self, filename):
+        self._table.set_delta(self._table.set_filenames, self._row, filename,
+                              self.current_filename)
+
+    @property
+    def _current_metadata_title(self):
+        return self._table.titles[self._row]
+
+    @_current_metadata_title.setter
+    def _current_metadata_title(self, title):
+        self._table.titles[self._row] = title
+
+    @property
+    def _set_metadata_title(self):
+        return self._table.set_titles.get(self._row)
+
+    @_set_metadata_title.setter
+    def _set_metadata_title(self, title):
+        self._table.set_delta(self._table.set_titles, self._row, title)
+
+    @property
+    def _pending_title(self):
+        return self._table.pending.get(self._row)
+
+    @_pending_title.setter
+    def _pending_title(self, future):
+        self._table.set_delta(self._table.pending, self._row, future)
+
+    def __repr__(self):
+        return '<{0} row {1}: {2}>'.format(
+            type(self).__name__, self._row, self.current_path)
+
+
+def row_class(video_class):
+    '''Returns the class of the row views of videos of `video_class`'''
+
+    if video_class not in _ROW_CLASSES:
+        _ROW_CLASSES[video_class] = type(
+            video_class.__name__ + 'Row', (TableRow, video_class), {
+                '__slots__': ('_table', '_row'),
+                '__doc__': 'Row view of a ' + video_class.__name__ +
+                           ' video stored in a VideoTable',
+            })
+    return _ROW_CLASSES[video_class]
+
+
+class VideoTable:
+    '''Class to store the videos of a scan in shared columns'''
+
+    def __init__(self, timeout=None):
+
+        # Store the time limit for fetching the titles
+        self.timeout = timeout
+        # Store every directory once and map it to its number
+        self.directories = []
+        self._directory_numbers = {}
+        # Store the number of the directory of every row
+        self.row_directories = array('L')
+        # Store the current filename and title of every row, the titles
+        # are None until they are fetched
+        self.basenames = []
+        self.titles = []
+        # Store the view class of every row by number
+        self.row_classes = []
+        self._row_class_numbers = {}
+        self.row_kinds = array('B')
+        # Map the rows to the values set by the user and to their
+        # background fetches, only where there are any
+        self.set_paths = {}
+        self.set_filenames = {}
+        self.set_titles = {}
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.basenames)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.view(row)
+
+    def _directory_number(self, directory):
+        '''Returns the number of `directory`, storing it if it is new'''
+
+        number = self._directory_numbers.get(directory)
+        if number is None:
+            number = len(self.directories)
+            self.directories.append(directory)
+            self._directory_numbers[directory] = number
+        return number
+
+    def add(self, path, video_class):
+        '''Stores a new video of `video_class` at `path` and returns its
+        row view'''
+
+        directory, filename = os.path.split(path)
+        views = row_class(video_class)
+        kind = self._row_class_numbers.get(views)
+        if kind is None:
+            kind = len(self.row_classes)
+            self.row_classes.append(views)
+            self._row_class_numbers[views] = kind
+        self.row_directories.append(self._directory_number(directory))
+        self.basenames.append(filename)
+        self.titles.append(None)
+        self.row_kinds.append(kind)
+        return self.view(len(self) - 1)
+
+    def view(self, row):
+        '''Returns a view of the video stored in `row`'''
+
+        video = object.__new__(self.row_classes[self.row_kinds[row]])
+        video._table = self
+        video._row = row
+        return video
+
+    def path(self, row):
+        '''Returns the current path of the video stored in `row`'''
+
+        return os.path.join(self.directories[self.row_directories[row]],
+                            self.basenames[row])
+
+    def move(self, row, path):
+        '''Changes the current path of the video stored in `row`'''
+
+        directory, filename = os.path.split(path)
+        self.row_directories[row] = self._directory_number(directory)
+        self.basenames[row] = filename
+
+    @staticmethod
+    def set_delta(column, row, value, default=None):
+        '''Stores `value` for `row` in `column` unless it is `default`'''
+
+        if value == default:
+            column.pop(row, None)
+        else:
+            column[row] = value
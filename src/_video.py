@@ -0,0 +1,402 @@
+'''
+Module that defines the Video base class shared by the container classes.
+
+The Video class holds the current path, filename and title of a video and
+the corresponding values set by the user while editing the video. The
+current title is only fetched from the file the first time it is read, from
+the persistent title cache, the built-in parser of the container, the index
+of the fingerprints of the titles written or mediainfo, in that order.
+Titles are fetched in batches wherever possible so that the files the parser
+can't handle share a single mediainfo process.
+Subclasses provide the parser and the tools used to write a new title.
+
+Requires - mediainfo
+'''
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from _logs import error, debug, metrics
+from _mediainfo import probe_titles
+
+# Default number of videos fetched together in the background
+BATCH_SIZE = 64
+
+
+class Video:
+    '''Class to handle the operations common to every video file'''
+
+    # Videos have no attribute dictionary, the row views of a VideoTable
+    # replace these fields with properties
+    __slots__ = ('current_filename', 'set_filename', 'current_path',
+                 'set_path', 'timeout', '_current_metadata_title',
+                 '_set_metadata_title', '_pending_title')
+
+    # Store the persistent title cache shared by all videos, if enabled,
+    # either the cache itself or a LazyStore opening it on first use
+    cache = None
+    # Store the index of the titles written by fingerprint, if enabled
+    fingerprints = None
+    # Store whether titles are read by the built-in parser before mediainfo
+    native = True
+    # Store the name used in log messages
+    sign = "video"
+
+    def __init__(self, filepath, timeout=None):
+
+        # Store the current filename
+        self.current_filename = os.path.basename(filepath)
+        # Store the filename set by the user
+        self.set_filename = os.path.basename(filepath)
+        # Store the current path
+        self.current_path = filepath
+        # Store the path entered by the user
+        self.set_path = filepath
+        # Store the time limit for fetching the title
+        self.timeout = timeout
+
+        # The title is only fetched the first time it is read
+        self._current_metadata_title = None
+        self._set_metadata_title = None
+        # Store the background fetch of the title, if one was scheduled
+        self._pending_title = None
+
+    @property
+    def current_metadata_title(self):
+        '''The current title of the video, fetched on first access'''
+
+        title = self._current_metadata_title
+        if title is None:
+            pending = self._pending_title
+            if pending is not None and not pending.cancelled():
+                title = pending.result()
+            else:
+                # A batch may have handed the title over since it was read
+                title = self._current_metadata_title
+                if title is None:
+                    title = self.load_metadata()
+            self._current_metadata_title = title
+            # The fetch is only kept until its title is known
+            self._pending_title = None
+        return title
+
+    @current_metadata_title.setter
+    def current_metadata_title(self, title):
+        self._current_metadata_title = title
+
+    @property
+    def set_metadata_title(self):
+        '''The title entered by the user, defaults to the current title'''
+
+        if self._set_metadata_title is None:
+            return self.current_metadata_title
+        return self._set_metadata_title
+
+    @set_metadata_title.setter
+    def set_metadata_title(self, title):
+        self._set_metadata_title = title
+
+    @classmethod
+    def probe_many(cls, videos, workers):
+        '''Fetches the titles of the videos in `videos`, all handled by
+        this class, in batches spread over a pool of `workers` threads'''
+
+        unknown = [video for video in videos if video._needs_title()]
+        # A single worker gains nothing from a pool, so probe in place
+        if workers == 1:
+            for start in range(0, len(unknown), BATCH_SIZE):
+                batch = unknown[start:start + BATCH_SIZE]
+                for video, title in zip(batch, cls.load_many(batch)):
+                    video.current_metadata_title = title
+        else:
+            # Give every worker a share of the videos
+            size = max(1, min(BATCH_SIZE, -(-len(unknown) // workers)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                cls.prefetch_many(unknown, executor, size)
+                # Wait for every batch before the pool is shut down
+                for video in unknown:
+                    _ = video.current_metadata_title
+        # Wait for the videos that were already being fetched
+        for video in videos:
+            _ = video.current_metadata_title
+
+    @classmethod
+    def prefetch_many(cls, videos, executor, size=BATCH_SIZE):
+        '''Schedules the titles of the videos in `videos`, all handled by
+        this class, to be fetched in the background in batches of `size`'''
+
+        for batch in cls.pending_batches(videos, size):
+            executor.submit(cls._fetch_batch, batch)
+
+    @classmethod
+    def pending_batches(cls, videos, size=BATCH_SIZE):
+        '''
+        Marks the titles of the videos in `videos` that are neither known nor
+        being fetched as pending and returns those videos in batches of
+        `size`. Every batch must then be passed to `start_batch` and
+        `finish_batch` by whoever fetches it.
+        '''
+
+        unknown = [video for video in videos if video._needs_title()]
+        batches = []
+        for start in range(0, len(unknown), size):
+            batch = unknown[start:start + size]
+            for video in batch:
+                video._pending_title = Future()
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def start_batch(videos):
+        '''Returns the videos of a pending batch whose fetch hasn't been
+        cancelled, marking them as being fetched'''
+
+        return [video for video in videos
+                if video._pending_title.set_running_or_notify_cancel()]
+
+    @staticmethod
+    def finish_batch(videos, titles=None, exception=None):
+        '''Hands the `titles` fetched for a started batch, or the
+        `exception` raised while fetching them, to the waiting readers'''
+
+        for index, video in enumerate(videos):
+            pending = video._pending_title
+            if exception is not None:
+                pending.set_exception(exception)
+                continue
+            # Store the title before dropping the fetch, readers that
+            # already hold the fetch get the title from it
+            video._current_metadata_title = titles[index]
+            video._pending_title = None
+            pending.set_result(titles[index])
+
+    @classmethod
+    def _fetch_batch(cls, videos):
+        '''Fetches the titles of a pending batch'''
+
+        videos = cls.start_batch(videos)
+        try:
+            titles = cls.load_many(videos)
+        except Exception as exc:
+            cls.finish_batch(videos, exception=exc)
+            return
+        cls.finish_batch(videos, titles)
+
+    def _needs_title(self):
+        '''Checks whether the title is neither known nor being fetched'''
+
+        return self._current_metadata_title is None and \
+            self._pending_title is None
+
+    def title_changed(self):
+        '''Checks whether a new title is queued without fetching the title
+        when none has been entered'''
+
+        if self._set_metadata_title is None:
+            return False
+        return self.current_metadata_title != self._set_metadata_title
+
+    def prefetch(self, executor):
+        '''Schedules the title to be fetched in the background'''
+
+        if self._needs_title():
+            self._pending_title = executor.submit(self.load_metadata)
+
+    def cancel_prefetch(self):
+        '''Cancels the background fetch of the title if it hasn't started'''
+
+        pending = self._pending_title
+        if pending is not None:
+            pending.cancel()
+
+    def load_metadata(self):
+        '''Method to fetch the current title from the file metadata'''
+
+        return self.load_many([self])[0]
+
+    @classmethod
+    def load_many(cls, videos):
+        '''
+        Fetches the titles of the videos in `videos` from the cache or the
+        built-in parser, and those of the remaining videos with a single
+        mediainfo run. Returns the titles in order.
+        '''
+
+        titles, stats, missing = cls.load_local_many(videos)
+        probed = probe_titles(list(missing), videos[0].timeout) \
+            if missing else {}
+        return cls.merge_probed(titles, stats, missing, probed)
+
+    @classmethod
+    def load_local_many(cls, videos):
+        '''
+        Fetches the titles of the videos in `videos` from the cache or the
+        built-in parser. Returns the titles, `None` where they are missing,
+        the stats of the files and a dictionary mapping the path of every
+        video left for mediainfo to its position.
+        '''
+
+        titles = []
+        missing = {}
+        stats = []
+        for video in videos:
+            stat = video._stat()
+            stats.append(stat)
+            title = video._load_local(stat)
+            if title is None:
+                missing[video.current_path] = len(titles)
+            titles.append(title)
+        return titles, stats, missing
+
+    @classmethod
+    def merge_probed(cls, titles, stats, missing, probed):
+        '''Fills in and caches the titles `probed` by mediainfo, returns
+        the complete list of titles'''
+
+        for path, title in probed.items():
+            index = missing[path]
+            titles[index] = title
+            if stats[index] is not None and cls.cache is not None:
+                cls.cache.put(stats[index], title)
+        return ["N/A" if title is None else title for title in titles]
+
+    def _load_local(self, stat):
+        '''Fetches the title from the cache, the built-in parser or the
+        fingerprint index without starting any process, returns `None` on
+        failure'''
+
+        # Look the title up in the persistent cache first
+        if stat is not None and self.cache is not None:
+            title = self.cache.get(stat)
+            if title is not None:
+                metrics.count('probe.cache_hits')
+                debug("Cached title for %s", self.sign, self.current_path)
+                return title
+
+        title = None
+        if self.native:
+            with metrics.timer('probe'):
+                title = self._read_title()
+        # Sampling the fingerprint costs more reads than the parser, so it
+        # only stands in for mediainfo
+        if title is None and stat is not None and \
+                self.fingerprints is not None:
+            with metrics.timer('probe.fingerprint'):
+                entry = self.fingerprints.get(self.current_path, stat)
+            if entry is not None:
+                metrics.count('probe.fingerprint_hits')
+                title = entry[0]
+        if stat is not None and title is not None and self.cache is not None:
+            self.cache.put(stat, title)
+        return title
+
+    def _stat(self):
+        '''Returns the stat of the video if the title cache or the
+        fingerprint index is enabled'''
+
+        if self.cache is None and self.fingerprints is None:
+            return None
+        try:
+            return os.stat(self.current_path)
+        except OSError:
+            return None
+
+    def _read_title(self):
+        '''Reads the title with the built-in parser, returns `None` on
+        failure'''
+
+        return None
+
+    def update_metadata_fields(self):
+        '''
+        Method to apply the new metadata values to the video. Returns 0 on
+        success, 1 if the title was written with warnings and 2 on failure.
+        '''
+
+        # Nothing to write if no title was entered or it is the current one
+        if not self.title_changed():
+            return 0
+
+        # Try to overwrite the title in place before calling the tools
+        if self.write_native():
+            return self.title_written(0)
+        return self.title_written(self._edit_title())
+
+    def title_written(self, status_code):
+        '''Records the title once it has been written with `status_code`,
+        returns the status code'''
+
+        if status_code < 2:
+            self.current_metadata_title = self.set_metadata_title
+            self._update_cache()
+        return status_code
+
+    def write_native(self):
+        '''Writes the title in place if the built-in writer is enabled,
+        returns whether it did'''
+
+        return self.native and self._write_title()
+
+    def _write_title(self):
+        '''Writes the title in place, returns whether it did'''
+
+        return False
+
+    def edit_command(self):
+        '''Returns the arguments of the external command that writes the
+        title, or `None` if the title isn't written by a command'''
+
+        return None
+
+    def edit_status(self, returncode, output):
+        '''Returns the status code of the external command, like
+        `update_metadata_fields`'''
+
+        return 0 if returncode == 0 else 2
+
+    def _edit_title(self):
+        '''Writes the title with an external tool, returns a status code
+        like `update_metadata_fields`'''
+
+        # Only the files the built-in writers can't handle need it
+        import subprocess
+
+        command = self.edit_command()
+        metrics.count('subprocess.' + command[0])
+        try:
+            with metrics.timer('apply.' + command[0]):
+                result = subprocess.run(
+                    command,
+                    universal_newlines=True,
+                    stdout=subprocess.PIPE
+                )
+        except OSError as exc:
+            error("Failed to run {0}: {1}".format(command[0], exc), self.sign)
+            return 2
+        return self.edit_status(result.returncode, result.stdout)
+
+    def _update_cache(self):
+        '''Records the title that was just written in the title cache and
+        the fingerprint index'''
+
+        stat = self._stat()
+        if stat is None:
+            return
+        if self.cache is not None:
+            self.cache.put(stat, self.current_metadata_title)
+        if self.fingerprints is not None:
+            self.fingerprints.put(self.current_path, stat,
+                                  self.current_metadata_title)
+
+    def update_file_fields(self):
+        '''Method to apply the new filename and path to the video'''
+
+        try:
+            os.renames(self.current_path, self.set_path)
+            self.current_path = self.set_path
+            self.current_filename = self.set_filename
+        except OSError:
+            error("Failed to rename the file", self.sign)
+            error(self.current_path, self.sign)
+            return 1
+
+        return 0
@@ -0,0 +1,388 @@
+'''
+Watch mode to rename and retitle videos as they arrive in a directory.
+
+A watcher reports the video files that are created or modified below the
+watched directory, using inotify on Linux and periodic scans elsewhere. A
+file is only edited once its size and modification time have stopped
+changing for a while, so downloads in progress are left alone. The settled
+files are then edited in batches with a saved set of patterns, which keeps
+the work per event proportional to the number of new files. The events
+caused by the session's own edits are ignored for a settle window, after
+which a file arriving under the same name, such as a repack, is edited like
+any other.
+
+New files are numbered like a batch run would number them: `{dir}` is the
+position of their directory among the directories holding videos. Their
+`{file}` numbers follow the videos already in their directory, so that a
+new file never takes the number of an episode that is already there, and
+renames onto existing files are refused rather than overwriting them.
+'''
+
+import bisect
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+from _logs import error, warning, debug
+from _scanner import scan
+from _probe import create_video
+from _apply import ApplyEngine
+from _rename_plan import RenamePlan
+from _delta import plan_delta
+from _sidecars import attach_sidecars
+from _normalize_path import normalize_path, PathValidator
+from _pattern import Pattern, PatternError
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+# Size of the fixed part of an inotify event
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_rules(path):
+    '''Loads the patterns and offsets saved by `save_rules`'''
+
+    with open(path) as file:
+        rules = json.load(file)
+    if not isinstance(rules, dict):
+        raise ValueError("the rules must be a JSON object")
+    rules.setdefault('m_pattern', '\\')
+    rules.setdefault('f_pattern', '\\')
+    rules.setdefault('offset', [1, 1])
+    rules.setdefault('regex', None)
+    offset = rules['offset']
+    if not isinstance(offset, list) or len(offset) != 2 or \
+            not all(type(number) is int for number in offset):
+        raise ValueError("invalid offset " + json.dumps(offset))
+    return rules
+
+
+def save_rules(path, m_pattern, f_pattern, offset, regex=None):
+    '''Saves a set of patterns and offsets to be used in watch mode'''
+
+    with open(path, 'w') as file:
+        json.dump({
+            'm_pattern': m_pattern or '\\',
+            'f_pattern': f_pattern or '\\',
+            'offset': list(offset),
+            'regex': regex,
+        }, file, indent=4)
+
+
+class PollingWatcher:
+    '''Class to find new or modified videos by rescanning the tree'''
+
+    def __init__(self, root, extensions, interval=5.0):
+
+        self.root = root
+        self.extensions = extensions
+        # Store the number of seconds between two scans
+        self.interval = interval
+        # Map every known video to its size and modification time
+        self.known = self._snapshot()
+
+    def _snapshot(self):
+        '''Returns the size and modification time of every video'''
+
+        snapshot = {}
+        for _, files in scan(self.root, self.extensions):
+            for file in files:
+                try:
+                    stat = os.stat(os.path.join(self.root, file))
+                except OSError:
+                    continue
+                snapshot[file] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        '''Waits up to `timeout` seconds and returns the changed videos'''
+
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._snapshot()
+        changed = [file for file, state in snapshot.items()
+                   if self.known.get(file) != state]
+        self.known = snapshot
+        return changed
+
+    def close(self):
+        '''Releases the resources held by the watcher'''
+
+
+class InotifyWatcher:
+    '''Class to find new or modified videos with Linux inotify'''
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root, extensions):
+
+        self.root = root
+        self.extensions = tuple(extensions)
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Map every watch descriptor to the directory it watches
+        self._watches = {}
+        self._add_tree('')
+
+    def _add_tree(self, directory):
+        '''Watches `directory` and every directory below it'''
+
+        path = os.path.join(self.root, directory)
+        descriptor = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), self.MASK)
+        if descriptor < 0:
+            warning("Failed to watch " + path, "watch")
+            return []
+        self._watches[descriptor] = directory
+
+        # Videos already present in a new directory count as new files
+        found = []
+        try:
+            with os.scandir(path) as iterator:
+                for entry in iterator:
+                    if entry.name.startswith('.'):
+                        continue
+                    relative = os.path.join(directory, entry.name)
+                    if entry.is_dir():
+                        found.extend(self._add_tree(relative))
+                    elif entry.name.lower().endswith(self.extensions):
+                        found.append(relative)
+        except OSError as exc:
+            warning("Failed to read directory: " + str(exc), "watch")
+        return found
+
+    def poll(self, timeout):
+        '''Waits up to `timeout` seconds and returns the changed videos'''
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buffer = os.read(self._fd, 65536)
+        changed = []
+        pos = 0
+        while pos < len(buffer):
+            descriptor, mask, _, length = EVENT_HEADER.unpack_from(
+                buffer, pos)
+            name = buffer[pos + EVENT_HEADER.size:
+                          pos + EVENT_HEADER.size + length].rstrip(b'\0')
+            pos += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                warning("Event queue overflowed, some files were missed.",
+                        "watch")
+                continue
+            if descriptor not in self._watches or not name:
+                continue
+            name = os.fsdecode(name)
+            if name.startswith('.'):
+                continue
+            relative = os.path.join(self._watches[descriptor], name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self._add_tree(relative))
+            elif name.lower().endswith(self.extensions):
+                changed.append(relative)
+        return changed
+
+    def close(self):
+        '''Releases the resources held by the watcher'''
+
+        os.close(self._fd)
+
+
+def open_watcher(root, extensions, interval=5.0):
+    '''Returns an inotify watcher if possible, a polling watcher otherwise'''
+
+    try:
+        return InotifyWatcher(root, extensions)
+    except (OSError, AttributeError, TypeError) as exc:
+        debug("inotify unavailable: " + str(exc), "watch")
+        return PollingWatcher(root, extensions, interval)
+
+
+class WatchSession:
+    '''Class to apply a set of rules to the videos arriving below `root`'''
+
+    def __init__(self, root, rules, extensions, settle=10.0, interval=5.0,
+                 workers=None, device_limit=None, sidecars=True):
+
+        self.root = root
+        # Parse the patterns once, a pattern of \ leaves the field as is
+        self.m_pattern = Pattern(rules['m_pattern'], rules.get('regex')) \
+            if rules['m_pattern'] != '\\' else None
+        self.f_pattern = Pattern(rules['f_pattern'], rules.get('regex')) \
+            if rules['f_pattern'] != '\\' else None
+        self.directory_offset, self.file_offset = rules['offset']
+        self.extensions = tuple(extensions)
+        # Store how long a file must stay unchanged before it is edited
+        self.settle = settle
+        # Store how often the tree is rescanned when polling
+        self.interval = interval
+        self.engine = ApplyEngine(workers, device_limit)
+        # Store whether subtitle files are moved along with their videos
+        self.sidecars = sidecars
+        self.watcher = open_watcher(root, extensions, interval)
+
+        # Store the sorted directories that hold videos
+        self.directories = sorted({
+            directory for directory, _ in scan(root, extensions)})
+        # Map the files waiting to settle to their last state and the time
+        # at which it was first seen
+        self.pending = {}
+        # Map the paths produced by our own edits to the time they were
+        # made, their events are ignored until the entries expire
+        self.produced = {}
+        # Map every directory to the next `{file}` value handed out in it
+        self.next_numbers = {}
+
+    def _directory_number(self, directory):
+        '''Returns the `{dir}` value of `directory`'''
+
+        index = bisect.bisect_left(self.directories, directory)
+        if index == len(self.directories) or \
+                self.directories[index] != directory:
+            self.directories.insert(index, directory)
+        return self.directory_offset + index
+
+    def _file_numbers(self, directory, files):
+        '''Returns the `{file}` value of each of the new `files` in
+        `directory`, numbering them after the videos already there'''
+
+        count = 0
+        try:
+            with os.scandir(os.path.join(self.root, directory)) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(self.extensions) and \
+                            not entry.name.startswith('.') and \
+                            os.path.join(directory, entry.name) not in files:
+                        count += 1
+        except OSError as exc:
+            debug("Failed to list %s: %s", "watch", directory, exc)
+        first = max(self.file_offset + count,
+                    self.next_numbers.get(directory, self.file_offset))
+        self.next_numbers[directory] = first + len(files)
+        return {file: first + index
+                for index, file in enumerate(sorted(files))}
+
+    def _settled(self):
+        '''Returns the pending files that have stopped changing'''
+
+        now = time.monotonic()
+        settled = []
+        for file, (state, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(os.path.join(self.root, file))
+            except OSError:
+                del self.pending[file]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != state:
+                self.pending[file] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[file]
+                settled.append(file)
+        return sorted(settled)
+
+    def _apply(self, files):
+        '''Edits the settled `files` according to the rules'''
+
+        created = []
+        by_directory = {}
+        for file in files:
+            video = create_video(
+                os.path.join(os.path.abspath(self.root), file))
+            if video is None:
+                continue
+            created.append((file, video))
+            by_directory.setdefault(os.path.dirname(file), set()).add(file)
+        numbers = {}
+        for directory, new in by_directory.items():
+            numbers.update(self._file_numbers(directory, new))
+
+        videos = []
+        validator = PathValidator()
+        for file, video in created:
+            videos.append(video)
+            directory = os.path.dirname(file)
+            directory_number = self._directory_number(directory)
+            file_number = numbers[file]
+            if self.m_pattern:
+                video.set_metadata_title = self.m_pattern.render(
+                    video, directory_number, file_number)
+            if self.f_pattern:
+                path = normalize_path(self.f_pattern.render(
+                    video, directory_number, file_number), validator,
+                    current=video.current_path)
+                if path == 1:
+                    return 1
+                video.set_path = path
+                video.set_filename = os.path.basename(path)
+
+        # New videos that already match the rules are left alone
+        changed, _ = plan_delta(videos)
+        plan = RenamePlan.from_videos(videos)
+        if self.sidecars:
+            attach_sidecars(plan)
+        # Nobody confirms the changes, so existing files are never replaced
+        if plan.validate(overwrite=False) or \
+                self.engine.apply_metadata(changed) or \
+                plan.execute():
+            return 1
+        now = time.monotonic()
+        for video in videos:
+            self.produced[os.path.relpath(video.current_path, self.root)] = \
+                now
+        print("Applied changes to {0} new videos.".format(len(changed)))
+        return 0
+
+    def _expire_produced(self):
+        '''Forgets the paths produced by our own edits once their events
+        have been seen, so that a file arriving later under the same name
+        is edited again'''
+
+        # A polling watcher reports the edits one rescan late at most
+        expired = time.monotonic() - self.settle - self.interval
+        for file, since in list(self.produced.items()):
+            if since <= expired:
+                del self.produced[file]
+
+    def run(self):
+        '''Watches the directory until interrupted'''
+
+        print("Watching " + os.path.abspath(self.root) +
+              " for new videos. Press Ctrl+C to stop.")
+        try:
+            while True:
+                for file in self.watcher.poll(1.0):
+                    if file in self.produced:
+                        continue
+                    if file not in self.pending:
+                        debug("New video " + file, "watch")
+                    self.pending[file] = (None, time.monotonic())
+                self._expire_produced()
+
+                settled = self._settled()
+                try:
+                    status_code = self._apply(settled) if settled else 0
+                except PatternError as exc:
+                    error(str(exc), "watch")
+                    status_code = 1
+                if status_code:
+                    error("Failed to apply changes to new videos.", "watch")
+        except KeyboardInterrupt:
+            debug("Watch stopped by user.", "watch")
+        finally:
+            self.watcher.close()
+        return 0
@@ -0,0 +1,319 @@
+#! python3.6
+'''
+Script to benchmark the scan, probe, plan and apply phases on a synthetic
+library.
+
+The script generates a tree of small but valid Matroska files with a
+configurable number of files, directory depth and title length, and puts
+stub `mediainfo` and `mkvpropedit` executables with a configurable latency
+first on the PATH. Every phase is timed separately and reported in files per
+second along with the peak resident memory of the process. The results can
+be saved as JSON and compared with those of another commit.
+
+With --startup, the script instead launches the entry point as a headless
+batch job on an empty directory, the way a user would, and fails if it takes
+longer than the budget on top of starting a bare interpreter. The imports of
+a slow launch are listed with `-X importtime` (Python 3.7 and later).
+
+Requires - Linux or macOS (the stubs are shell scripts)
+'''
+
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from _ebml import encode_id, encode_size
+from _mediainfo import START, SEPARATOR, END
+from _scanner import scan
+from _probe import VideoGroups, probe_videos
+from _pattern import compile_patterns, apply_patterns
+from _apply import ApplyEngine
+from _rename_plan import RenamePlan
+from _video import Video
+
+# Shell scripts standing in for the external tools. The mkvpropedit stub
+# doesn't touch the file, only its latency matters.
+MEDIAINFO_STUB = '''#!/bin/sh
+sleep {latency}
+shift
+for file in "$@"; do
+    printf '%s\\n' "{start}$file{separator}Stub title{end}"
+done
+'''
+MKVPROPEDIT_STUB = '''#!/bin/sh
+sleep {latency}
+exit 0
+'''
+
+
+def element(element_id, payload):
+    '''Encodes a complete EBML element'''
+
+    return encode_id(element_id) + encode_size(len(payload)) + payload
+
+
+def synthetic_matroska(title, padding=64):
+    '''Returns the bytes of a minimal Matroska file titled `title`'''
+
+    header = element(0x1A45DFA3, element(0x4282, b'matroska') +
+                     element(0x4287, b'\x04') + element(0x4285, b'\x02'))
+    info = element(0x1549A966,
+                   element(0x2AD7B1, (1000000).to_bytes(3, 'big')) +
+                   element(0x7BA9, title.encode('utf-8')) +
+                   element(0xEC, b'\0' * padding))
+    cluster = element(0x1F43B675, element(0xE7, b'\0') + b'\0' * 4096)
+    return header + element(0x18538067, info + cluster)
+
+
+def generate_corpus(root, count, depth, fanout, title_size):
+    '''
+    Writes `count` synthetic videos below `root`, spread over directories
+    nested `depth` levels deep with `fanout` subdirectories each.
+    '''
+
+    directories = ['']
+    for _ in range(depth):
+        directories = [os.path.join(parent, 'dir{0:02d}'.format(index))
+                       for parent in directories for index in range(fanout)]
+    for number in range(count):
+        directory = os.path.join(root, directories[number % len(directories)])
+        os.makedirs(directory, exist_ok=True)
+        title = ('Title {0} '.format(number) * title_size)[:title_size]
+        with open(os.path.join(
+                directory, 'video{0:06d}.mkv'.format(number)), 'wb') as file:
+            file.write(synthetic_matroska(title))
+
+
+def install_stubs(directory, latency):
+    '''Writes the stub tools to `directory` and puts it first on the PATH'''
+
+    for name, script in (('mediainfo', MEDIAINFO_STUB),
+                         ('mkvpropedit', MKVPROPEDIT_STUB)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as file:
+            file.write(script.format(
+                latency=latency, start=START, separator=SEPARATOR, end=END))
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+
+
+def peak_rss():
+    '''Returns the peak resident memory of the process in MiB'''
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(results, name, count, function):
+    '''Runs `function`, stores its timings under `name` and returns its
+    result'''
+
+    start = time.perf_counter()
+    value = function()
+    elapsed = time.perf_counter() - start
+    results[name] = {
+        'seconds': round(elapsed, 4),
+        'files_per_second': round(count / elapsed, 1) if elapsed else None,
+        'peak_rss_mib': round(peak_rss(), 1),
+    }
+    print("{0:<8} {1:>9.3f} s {2:>12} files/s {3:>9.1f} MiB".format(
+        name, elapsed, results[name]['files_per_second'],
+        results[name]['peak_rss_mib']))
+    return value
+
+
+def run_benchmark(args, root):
+    '''Runs every phase on the corpus in `root` and returns the timings'''
+
+    results = {}
+    extensions = ('.mkv',)
+
+    batches = timed(results, 'scan', args.count,
+                    lambda: list(scan(root, extensions)))
+
+    def probe():
+        video_groups = VideoGroups(batches, args.timeout, root,
+                                   not args.objects)
+        probe_videos(video_groups.videos(), args.workers)
+        return video_groups
+    video_groups = timed(results, 'probe', args.count, probe)
+    # A full collection with every video alive stands for the pauses of
+    # the garbage collector during a large scan
+    timed(results, 'gc', args.count, gc.collect)
+
+    m_template, f_template = compile_patterns(
+        'Benchmark S{dir:02d}E{file:03d}',
+        'renamed/S{dir:02d}/E{file:03d}.mkv')
+    timed(results, 'plan', args.count, lambda: apply_patterns(
+        video_groups, m_template, f_template, 1, 1, root))
+
+    def apply():
+        videos = video_groups.videos()
+        plan = RenamePlan.from_videos(videos)
+        plan.validate()
+        ApplyEngine(args.apply_workers, args.device_limit) \
+            .apply_metadata(videos)
+        plan.execute()
+    timed(results, 'apply', args.count, apply)
+    return results
+
+
+def _launch_command(workdir):
+    '''Returns the command running a headless batch job of mkvedit on an
+    empty directory in `workdir`'''
+
+    library = os.path.join(workdir, 'library')
+    os.makedirs(library, exist_ok=True)
+    return [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'mkvedit.py'),
+            '-p', library, '-m', 'b', '-x', 'Title', '-y', 'Title.mkv',
+            '-o', 'False', '--plan', os.path.join(workdir, 'plan.jsonl')]
+
+
+def _median_time(command, runs, env):
+    '''Runs `command` `runs` times and returns the median number of
+    milliseconds a run took'''
+
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def startup_time(runs):
+    '''
+    Launches mkvedit in `runs` fresh interpreters and returns the median
+    number of milliseconds a launch took beyond starting a bare interpreter,
+    along with the modules a launch imported and their cumulative import
+    times.
+    '''
+
+    workdir = tempfile.mkdtemp(prefix='vidrenamer-startup-')
+    try:
+        # Keep the databases and journals of the user out of the timing
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(workdir, 'cache'))
+        command = [sys.executable] + _launch_command(workdir)
+        bare = _median_time([sys.executable, '-c', 'pass'], runs, env)
+        launch = _median_time(command, runs, env)
+        result = subprocess.run(
+            command[:1] + ['-X', 'importtime'] + command[1:], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+    finally:
+        shutil.rmtree(workdir)
+    modules = {}
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            modules[fields[2].strip()] = int(fields[1]) / 1000
+    return launch - bare, modules
+
+
+def check_startup(runs, budget):
+    '''Prints the startup time of mkvedit, returns 1 if it is over
+    `budget` milliseconds and 0 otherwise'''
+
+    median, modules = startup_time(runs)
+    print("startup  {0:>9.1f} ms (budget {1:.1f} ms)".format(median, budget))
+    if median <= budget:
+        return 0
+    print("Slowest imports:")
+    top_level = sorted((name for name in modules if '.' not in name),
+                       key=modules.get, reverse=True)
+    for name in top_level[:5]:
+        print("{0:<16} {1:>9.1f} ms".format(name, modules[name]))
+    return 1
+
+
+def compare(results, path):
+    '''Prints the speedup of `results` over the results saved at `path`'''
+
+    with open(path) as file:
+        previous = json.load(file)['phases']
+    print("Compared with " + path)
+    for name, timing in results.items():
+        if name in previous and timing['seconds']:
+            print("{0:<8} {1:>6.2f}x".format(
+                name, previous[name]['seconds'] / timing['seconds']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the phases of a batch job")
+    parser.add_argument('--count', type=int, default=1000,
+                        help='number of synthetic videos to generate.')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='depth of the generated directory tree.')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='number of subdirectories per directory.')
+    parser.add_argument('--title_size', type=int, default=32,
+                        help='length of the generated titles.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each stub tool sleeps before exiting.')
+    parser.add_argument('--no_native', action='store_true',
+                        help='use the stub tools instead of the built-in '
+                        'EBML reader and writer.')
+    parser.add_argument('--objects', action='store_true',
+                        help='keep every video in an object of its own '
+                        'instead of the shared video table.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of concurrent probes.')
+    parser.add_argument('--apply_workers', type=int, default=None,
+                        help='number of concurrent metadata edits.')
+    parser.add_argument('--device_limit', type=int, default=None,
+                        help='number of concurrent edits per device.')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a probe is abandoned.')
+    parser.add_argument('--output', default=None,
+                        help='save the results as JSON to this file.')
+    parser.add_argument('--compare', default=None,
+                        help='compare with results saved by --output.')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated corpus.')
+    parser.add_argument('--startup', action='store_true',
+                        help='only check the startup time of mkvedit.')
+    parser.add_argument('--startup_budget', type=float, default=60.0,
+                        help='milliseconds a launch of mkvedit may take on '
+                        'top of a bare interpreter.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of launches timed by --startup.')
+    args = parser.parse_args()
+
+    if args.startup:
+        sys.exit(check_startup(args.runs, args.startup_budget))
+
+    Video.native = not args.no_native
+
+    workdir = tempfile.mkdtemp(prefix='vidrenamer-bench-')
+    root = os.path.join(workdir, 'library')
+    try:
+        install_stubs(workdir, args.latency)
+        start = time.perf_counter()
+        generate_corpus(root, args.count, args.depth, args.fanout,
+                        args.title_size)
+        print("Generated {0} videos in {1:.3f} s".format(
+            args.count, time.perf_counter() - start))
+
+        results = run_benchmark(args, root)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump({'arguments': vars(args), 'phases': results},
+                          file, indent=4)
+        if args.compare:
+            compare(results, args.compare)
+    finally:
+        if args.keep:
+            print("Corpus kept in " + root)
+        else:
+            shutil.rmtree(workdir)
@@ -3,92 +3,63 @@ Module that defines the Matroska class and its member methods.
 
 The Matroska class describes a mkv video. It holds the current path, filename
 and title of a video and the corresponding values set by the user while
-editing the video.
+editing the video. The current title is only fetched from the file the
+first time it is read, using the built-in EBML parser and falling back to
+mediainfo for files the parser can't handle. New titles are written in place
+when they fit in the existing Segment Info, otherwise with mkvpropedit.
 
 Requires - mediainfo, mkvpropedit
 '''
 
 
-import os
-import subprocess
-from _logs import error, warning, debug
+from _logs import error, warning, debug, metrics
+from _ebml import EBMLError, read_title, write_title
+from _video import Video
 
 
-class Matroska:
+class Matroska(Video):
     '''Class to handle all the operations related to a single mkv video file'''
 
-    def __init__(self, filepath):
+    __slots__ = ()
+    sign = "matroska"
 
-        # Store the current filename
-        self.current_filename = os.path.basename(filepath)
-        # Store the filename set by the user
-        self.set_filename = os.path.basename(filepath)
-        # Store the current path
-        self.current_path = filepath
-        # Store the path entered by the user
-        self.set_path = filepath
+    def _read_title(self):
+        '''Reads the title with the EBML parser, returns `None` on failure'''
 
-        # Fetch the current title from the file metadata using mediainfo
-        file_metadata = subprocess.run(
-            ["mediainfo --Inform=\"General;%Title%\" \"" + filepath + "\""],
-            universal_newlines=True,
-            shell=True,
-            stdout=subprocess.PIPE
-        )
-        debug(str(file_metadata), "matroska")
+        try:
+            with metrics.timer('probe.ebml'):
+                title = read_title(self.current_path)
+        except (EBMLError, OSError) as exc:
+            debug("EBML parser failed: %s", "matroska", exc)
+            return None
+        return title or "N/A"
+
+    def _write_title(self):
+        '''Writes the title with the EBML writer, returns whether it did'''
 
-        # Check if the mediainfo command ran successfully
-        # by looking at the return code
-        if file_metadata.returncode:
-            warning("Mediainfo failed to run correctly.", "matroska")
+        try:
+            with metrics.timer('apply.ebml'):
+                return write_title(self.current_path,
+                                   self.set_metadata_title)
+        except (EBMLError, OSError) as exc:
+            debug("EBML writer failed: %s", "matroska", exc)
+            return False
 
-        # Store the current title
-        if file_metadata.returncode or file_metadata.stdout == '\n':
-            self.current_metadata_title = "N/A"
-        else:
-            self.current_metadata_title = file_metadata.stdout.splitlines()[0]
-        # Store the title entered by the user
-        self.set_metadata_title = self.current_metadata_title
+    def edit_command(self):
+        '''Returns the mkvpropedit command that sets the title'''
 
-    def update_metadata_fields(self):
-        '''Method to apply the new metadata values to the video'''
+        return ['mkvpropedit', self.current_path,
+                '--edit', 'info', '--set', 'title=' + self.set_metadata_title]
 
-        # Build the string to call mkvpropedit and set the metadata correctly
-        shell_command = ''.join(["mkvpropedit \"",
-                                 self.current_path,
-                                 "\" --edit info --set \"title=",
-                                 self.set_metadata_title,
-                                 "\""]
-                                )
-        result = subprocess.run(
-            [shell_command],
-            universal_newlines=True,
-            shell=True,
-            stdout=subprocess.PIPE
-        )
+    def edit_status(self, returncode, output):
+        '''Interprets the exit code of mkvpropedit'''
 
-        if result.returncode == 0:
-            self.current_metadata_title = self.set_metadata_title
+        if returncode == 0:
             return 0
-        if result.returncode == 1:
-            warning("mkvpropedit: " + result.stdout, "matroska")
+        if returncode == 1:
+            warning("mkvpropedit: " + output, "matroska")
             warning(self.current_path, "matroska")
-            self.current_metadata_title = self.set_metadata_title
             return 1
-        error("mkvpropedit:" + result.stdout, "matroska")
+        error("mkvpropedit:" + output, "matroska")
         error(self.current_path, "matroska")
         return 2
-
-    def update_file_fields(self):
-        '''Method to apply the new filename and path to the video'''
-
-        try:
-            os.renames(self.current_path, self.set_path)
-            self.current_path = self.set_path
-            self.current_filename = self.set_filename
-        except OSError:
-            error("Failed to rename the file", "matroska")
-            error(self.current_path, "matroska")
-            return 1
-
-        return 0
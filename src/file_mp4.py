@@ -3,13 +3,71 @@ Module that defines the Mpeg4 class and its member methods.
 
 The Mpeg4 class describes a mp4 video. It holds the current path, filename
 and title of a video and the corresponding values set by the user while
-editing the video.
+editing the video. The current title is only fetched from the file the
+first time it is read, using the built-in atom parser and falling back to
+mediainfo for files the parser can't handle. New titles are written in place
+when they fit in the existing metadata list, otherwise with mutagen, which
+may have to rewrite the whole `moov` atom.
 
-Requires - mutagen
+Requires - mediainfo, mutagen (optional)
 '''
 
-# import mutagen
+from _logs import error, debug, metrics
+from _mp4 import MP4Error, read_title, write_title
+from _video import Video
 
+try:
+    import mutagen.mp4
+except ImportError:
+    mutagen = None
 
-class Mpeg4:
-    pass
+
+class Mpeg4(Video):
+    '''Class to handle all the operations related to a single mp4 video file'''
+
+    __slots__ = ()
+    sign = "mpeg4"
+
+    def _read_title(self):
+        '''Reads the title with the atom parser, returns `None` on failure'''
+
+        try:
+            with metrics.timer('probe.mp4'):
+                title = read_title(self.current_path)
+        except (MP4Error, OSError) as exc:
+            debug("MP4 parser failed: %s", "mpeg4", exc)
+            return None
+        return title or "N/A"
+
+    def _write_title(self):
+        '''Writes the title with the atom writer, returns whether it did'''
+
+        try:
+            with metrics.timer('apply.mp4'):
+                return write_title(self.current_path,
+                                   self.set_metadata_title)
+        except (MP4Error, OSError) as exc:
+            debug("MP4 writer failed: %s", "mpeg4", exc)
+            return False
+
+    def _edit_title(self):
+        '''Writes the title with mutagen'''
+
+        if mutagen is None:
+            error("The title doesn't fit in place and mutagen isn't "
+                  "installed.", "mpeg4")
+            error(self.current_path, "mpeg4")
+            return 2
+
+        try:
+            with metrics.timer('apply.mutagen'):
+                video = mutagen.mp4.MP4(self.current_path)
+                if video.tags is None:
+                    video.add_tags()
+                video.tags['\xa9nam'] = [self.set_metadata_title]
+                video.save()
+        except (mutagen.MutagenError, OSError) as exc:
+            error("mutagen: " + str(exc), "mpeg4")
+            error(self.current_path, "mpeg4")
+            return 2
+        return 0
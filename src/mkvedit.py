@@ -5,9 +5,10 @@ Can currently perform the following
  * Edit filename, file title, directory
  * Batch rename folders
  * Provide customizable renaming schemes.
+ * Move subtitle files along with their videos
+ * Recognize titled videos by their content after they have moved
 
- TODO: * Add subtitle renaming support
-       * Add mp4, avi, etc support
+ TODO: * Add avi, etc support
        * Add support for downloading subtitles
        * Add support for automatically fetching info
 
@@ -15,18 +16,51 @@ Requires - mkvpropedit, mediainfo, mutagen
 '''
 
 import os
-import argparse
-from glob import glob
-from ast import literal_eval
+import sys
 from _clrscr import clrscr
-from _logs import error, warning, debug
+from _logs import configure, error, warning, debug, metrics
 from _normalize_path import normalize_path
 from _colors import COLOR
-from file_mkv import Matroska
-
-
-def apply_changes(videos):
-    '''Method to apply changes to queued edits'''
+from _probe import probe_videos, Prefetcher, VideoGroups
+from _apply import ApplyEngine
+from _rename_plan import RenamePlan
+from _scanner import scan, extensions_for
+from _backends import BACKENDS
+from _pattern import PatternError, compile_patterns, apply_patterns
+from _video import Video
+from _stores import lazy_cache, lazy_fingerprints
+
+# argparse, ast and the modules that only some modes use are imported where
+# they are needed, so that a single run starts quickly
+
+
+def parse_offset(text):
+    '''Returns the directory and file offsets given by `--offset` as a
+    tuple, true and false stand for the default offsets. Returns `None` if
+    the offsets are invalid.'''
+
+    from ast import literal_eval
+
+    if text in ["True", "False"]:
+        return 1, 1
+    try:
+        offset = literal_eval(text)
+    except (ValueError, SyntaxError, TypeError):
+        return None
+    if not isinstance(offset, (tuple, list)) or len(offset) != 2 or \
+            not all(type(number) is int for number in offset):
+        return None
+    return tuple(offset)
+
+
+def apply_changes(videos, planned=None):
+    '''Method to apply changes to queued edits, the renames are checked
+    against every video of `planned` if given, including the videos that
+    keep their path'''
+
+    from _journal import open_journal, journal_record, sidecar_record, \
+        default_journal_path
+    from _sidecars import attach_sidecars
 
     # Store the total number of edited videos
     total_updated = len(videos)
@@ -37,27 +71,45 @@ def apply_changes(videos):
         print(video.current_filename + ":")
         if video.current_path != video.set_path:
             print("New path: " + video.set_path)
-        if video.current_metadata_title != video.set_metadata_title:
+        if video.title_changed():
             print("New title: " + video.set_metadata_title)
     process = input("Continue? (y/n) ")
     clrscr()
 
     if process.lower() in ["yes", "y"]:
-        for video in videos:
-            status_code = video.update_metadata_fields()
-            # Raise an error and stop further processing on error
-            if status_code == 2:
-                return 1
-            debug("Applied change for video - " +
-                  str(video.current_path), "run")
-
-        for video in videos:
-            status_code = video.update_file_fields()
-            # Raise an error and stop further processing on error
-            if status_code == 1:
-                return 1
-            debug("Renamed video - " + str(video.current_path), "run")
-
+        # Refuse the batch before editing anything if the renames collide
+        plan = RenamePlan.from_videos(planned or videos)
+        # Move the subtitle files of the renamed videos in the same pass
+        if not args.no_sidecars:
+            count = attach_sidecars(plan)
+            if count:
+                print("Moving {0} subtitle files with their videos.".format(
+                    count))
+        if plan.validate():
+            return 1
+
+        # Record every edit so that an interrupted batch can be resumed
+        journal = open_journal(
+            args.journal or default_journal_path(os.getcwd()),
+            [journal_record(video) for video in videos] +
+            [sidecar_record(move) for move in plan.moves
+             if move.video is None])
+
+        engine = pipeline or ApplyEngine(args.apply_workers,
+                                         args.device_limit)
+        # Raise an error and stop further processing on error, then rename
+        # all the videos in one pass
+        if engine.apply_metadata(videos, journal and journal.titled) or \
+                plan.execute(step=journal and journal.moved,
+                             intent=journal and journal.moving):
+            if journal is not None:
+                journal.close()
+                print("Run with --resume to retry or --rollback to undo "
+                      "the changes, the journal is " + journal.path)
+            return 1
+
+        if journal is not None:
+            journal.commit()
         print("Applied changes to {0} videos.".format(
             total_updated))
     else:
@@ -69,86 +121,100 @@ def apply_changes(videos):
     return 0
 
 
-def process_individual(video_list):
+def process_individual(video_groups):
     '''Method to process all the video files in a given directory
     and give the user the option to edit them one by one
     '''
 
-    # List to store all the video file objects
-    videos = []
-
-    # Instantiate objects to store the video data
-    for file in video_list:
-        videos.append(Matroska(os.getcwd() + "/" + file))
+    if pipeline is None:
+        # Instantiate objects to store the video data
+        videos = video_groups.videos()
+        # Fetch the titles of the upcoming videos while the user is busy
+        prefetcher = Prefetcher(videos, args.prefetch, args.workers)
+    else:
+        # Show every video as soon as its title arrives, while the rest of
+        # the tree is still being scanned and probed
+        video_groups.start_probing(pipeline=pipeline)
+        videos = video_groups.iter_videos()
+        prefetcher = None
 
     process_count = 1
     update_count = 0
     # Store whether user wants to continue processing or not
     stop_flag = False
-    # Store the total videos to process
-    total = len(videos)
     # List to store all the modified videos
     updated_videos = []
 
-    # Accept user inputs for the files
-    for video in videos:
-        while True:
-            debug("Processing file no. " + str(process_count), "run")
-
-            print("File {0} of {1}".format(
-                process_count, total))
-            print("Path: ", video.current_path)
-            print("Filename: ", video.current_filename)
-            print("Video title: ", video.current_metadata_title)
-
-            temp = input(
-                "Enter the new video path "
-                "(Press ENTER to skip) "
-            )
-            if temp:
-                path = normalize_path(temp)
-                if path == 1:
-                    return 1
-                video.set_path = temp
-                video.set_filename = os.path.basename(video.set_path)
-
-            temp = input(
-                "Enter the new video title "
-                "(Press ENTER to skip, \\ to copy filename) "
-            )
-            if temp == '\\':
-                video.set_metadata_title = os.path.splitext(
-                    video.set_filename)[0]
-            elif temp:
-                video.set_metadata_title = temp
-
-            # Add only those videos that have been updated
-            if (video.current_filename != video.set_filename) or (
-                    video.current_metadata_title != video.set_metadata_title):
-                updated_videos.append(video)
-                update_count += 1
-
-            process = input(
-                "Press r to redo, s to stop processing, e to exit, "
-                "ENTER to continue "
-            )
-            if process.lower() == 'r':
-                update_count -= 1
-                continue
-            elif process.lower() == 's':
-                stop_flag = True
-            elif process.lower() == 'e':
-                debug("Forced exit by user.", "run")
-                return 0
-
-            process_count += 1
-            clrscr()
-            break
-
-        # Stop the loop to proceed to applying the changes
-        if stop_flag:
-            break
-        stop_flag = False
+    try:
+        # Accept user inputs for the files
+        for index, video in enumerate(videos):
+            if prefetcher is not None:
+                prefetcher.advance(index)
+            # Store the total videos to process, known once the scan is done
+            total = video_groups.total()
+            while True:
+                debug("Processing file no. " + str(process_count), "run")
+
+                if total is None:
+                    print("File {0}".format(process_count))
+                else:
+                    print("File {0} of {1}".format(process_count, total))
+                print("Path: ", video.current_path)
+                print("Filename: ", video.current_filename)
+                print("Video title: ", video.current_metadata_title)
+
+                temp = input(
+                    "Enter the new video path "
+                    "(Press ENTER to skip) "
+                )
+                if temp:
+                    path = normalize_path(temp)
+                    if path == 1:
+                        return 1
+                    video.set_path = temp
+                    video.set_filename = os.path.basename(video.set_path)
+
+                temp = input(
+                    "Enter the new video title "
+                    "(Press ENTER to skip, \\ to copy filename) "
+                )
+                if temp == '\\':
+                    video.set_metadata_title = os.path.splitext(
+                        video.set_filename)[0]
+                elif temp:
+                    video.set_metadata_title = temp
+
+                # Add only those videos that have been updated
+                if (video.current_filename != video.set_filename) or (
+                        video.current_metadata_title !=
+                        video.set_metadata_title):
+                    updated_videos.append(video)
+                    update_count += 1
+
+                process = input(
+                    "Press r to redo, s to stop processing, e to exit, "
+                    "ENTER to continue "
+                )
+                if process.lower() == 'r':
+                    update_count -= 1
+                    continue
+                elif process.lower() == 's':
+                    stop_flag = True
+                elif process.lower() == 'e':
+                    debug("Forced exit by user.", "run")
+                    return 0
+
+                process_count += 1
+                clrscr()
+                break
+
+            # Stop the loop to proceed to applying the changes
+            if stop_flag:
+                break
+            stop_flag = False
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
 
     # Call the function to apply the edits that have been made if any
     if len(updated_videos) > 0:
@@ -158,15 +224,12 @@ def process_individual(video_list):
     return status_code
 
 
-def process_batch_metadata(video_list):
+def process_batch_metadata(video_groups):
     '''Method to process all the video files in a directory and
     give the user the option to edit them in a batch
     '''
 
-    # Store the list of videos in the current directory
-    videos = []
-    for file in video_list:
-        videos.append(Matroska(os.getcwd() + "/" + file))
+    from _delta import plan_delta
 
     while True:
         # Accept pattern to edit metadata
@@ -175,6 +238,8 @@ def process_batch_metadata(video_list):
                 COLOR["CYAN"] + "METADATA PATTERN" + COLOR["END"] + "\n"
                 "{dir:d} - directory based numbering, {file:d} "
                 "file based numbering" + "\n"
+                "{stem}, {parent}, {title} - current filename, directory "
+                "and title, {re[1]} - --regex captures" + "\n"
                 "Example - Person of Interest S{dir:02d}E{file:02d} -> "
                 "Person of Interest S01E01"
             )
@@ -188,6 +253,8 @@ def process_batch_metadata(video_list):
                 COLOR["CYAN"] + "FILE PATTERN" + COLOR["END"] + "\n"
                 "{dir:d} - directory based numbering, {file:d} "
                 "file based numbering" + "\n"
+                "{stem}, {parent}, {title} - current filename, directory "
+                "and title, {re[1]} - --regex captures" + "\n"
                 "Example - Person of Interest S{dir:02d}E{file:02d}.mkv -> "
                 "Person of Interest S01E01.mkv\n"
                 "Pattern must translate to a valid path"
@@ -205,38 +272,27 @@ def process_batch_metadata(video_list):
             directory_offset = 1
             file_offset = 1
         else:
-            try:
-                # Try literal evaluation of the argument and store in tuple
-                tup = literal_eval(args.offset)
-            except:
+            offset = parse_offset(args.offset)
+            if offset is None:
                 error("Invalid offsets passed.", "run")
                 return 1
-            directory_offset = tup[0]
-            file_offset = tup[1]
-
-        # Store current video's current path
-        current_path = os.path.dirname(videos[0].current_path)
-        for video in videos:
-            # Increment directory offset and reset file offset when
-            # the directory of the previous video doesn't match the current
-            if os.path.dirname(video.current_path) != current_path:
-                current_path = os.path.dirname(video.current_path)
-                directory_offset += 1
-                file_offset = 1
-                debug(current_path, "run")
-            if m_pattern != "\\":
-                video.set_metadata_title = m_pattern.format(
-                    dir=directory_offset, file=file_offset)
-            if f_pattern != "\\":
-                path = normalize_path(f_pattern.format(
-                    dir=directory_offset, file=file_offset
-                ))
-                # Return if the path is invalid
-                if path == 1:
-                    return 1
-                video.set_path = path
-                video.set_filename = os.path.basename(video.set_path)
-            file_offset += 1
+            directory_offset, file_offset = offset
+
+        # Parse the patterns once for the whole tree
+        try:
+            m_template, f_template = compile_patterns(
+                m_pattern, f_pattern, args.regex)
+        except PatternError as exc:
+            error(str(exc), "run")
+            return 1
+
+        # Probe the current titles while the rest of the tree is scanned
+        if m_template or (f_template and f_template.uses_title):
+            video_groups.start_probing(args.workers, pipeline)
+
+        if apply_patterns(video_groups, m_template, f_template,
+                          directory_offset, file_offset):
+            return 1
 
         process = input(
             "Press r to redo, e to exit, ENTER to continue "
@@ -250,8 +306,25 @@ def process_batch_metadata(video_list):
         clrscr()
         break
 
+    videos = video_groups.videos()
+    # The current titles are only needed to find the retitled videos
+    if m_pattern != "\\":
+        if pipeline is not None:
+            pipeline.probe_videos(videos)
+        else:
+            probe_videos(videos, args.workers)
+
+    # Leave out the videos that already match the patterns, they still
+    # keep other videos from being renamed onto them
+    changed, skipped = plan_delta(videos)
+    if skipped:
+        print("Skipping {0} videos that already match.".format(skipped))
+    if not changed:
+        print("Nothing to change.")
+        return 0
+
     # Call function to apply the changes
-    status_code = apply_changes(videos)
+    status_code = apply_changes(changed, videos)
 
     return status_code
 
@@ -269,15 +342,10 @@ def run():
         return 1
 
     # Recursively search the current working directory and subdirectories
-    # for files ending with a .mkv extension
-    video_list = []
-    mkv_list = glob('**/*.mkv', recursive=True)
-    # mp4_list = glob('**/*.mp4', recursive=True)
-    # avi_list = glob('**/*.mp4', recursive=True)
-    video_list.extend(mkv_list)
-    # video_list.extend(mp4_list)
-    # video_list.extend(avi_list)
-    video_list.sort()
+    # for video files, one directory at a time
+    video_groups = VideoGroups(scan(
+        os.curdir, extensions_for(args.types), not args.no_follow,
+        args.hidden, args.prune or ()), args.timeout)
 
     if not args.mode:
         print(
@@ -291,13 +359,14 @@ def run():
     process = args.mode or input("Single mode or batch mode? (s/b) ")
     if process.lower() in ["single", "s"]:
         clrscr()
-        status_code = process_individual(video_list)
+        status_code = process_individual(video_groups)
     elif process.lower() in ["batch", "b"]:
         clrscr()
-        status_code = process_batch_metadata(video_list)
+        status_code = process_batch_metadata(video_groups)
     else:
         error("Invalid processing option.", "run")
         return 1
+    video_groups.close()
 
     if status_code == 1:
         return 1
@@ -305,7 +374,194 @@ def run():
     return 0
 
 
+def _open_stream(path, mode):
+    '''Opens `path`, or the standard input or output if it is -'''
+
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    return open(path, mode)
+
+
+def _close_stream(stream):
+    '''Closes a stream opened by _open_stream'''
+
+    if stream not in (sys.stdin, sys.stdout):
+        stream.close()
+
+
+def plan_options():
+    '''Returns the options of the headless batch jobs given on the command
+    line, or `None` if the offsets are invalid'''
+
+    offset = parse_offset(args.offset)
+    if offset is None:
+        error("Invalid offsets passed.", "plan")
+        return None
+    return {
+        'm_pattern': args.m_pattern or "\\",
+        'f_pattern': args.f_pattern or "\\",
+        'regex': args.regex,
+        'offset': offset,
+        'extensions': extensions_for(args.types),
+        'follow_symlinks': not args.no_follow,
+        'hidden': args.hidden,
+        'prune': args.prune or (),
+        'timeout': args.timeout,
+        'workers': args.workers,
+        'cache': not args.no_cache,
+    }
+
+
+def plan():
+    '''Method that writes the plan of a batch job without prompting'''
+
+    from _multiroot import Shard, plan_shard
+    from _plan import write_plan
+
+    if not args.path or not os.path.isdir(os.path.expanduser(args.path)):
+        error("Directory not found.", "plan")
+        return 1
+    os.chdir(os.path.expanduser(args.path))
+
+    options = plan_options()
+    if options is None:
+        return 1
+    status_code, records, skipped = plan_shard(Shard(os.curdir), options)
+    if status_code == 0:
+        print("Planned {0} videos, skipped {1} that already match.".format(
+            len(records), skipped), file=sys.stderr)
+        stream = _open_stream(args.plan, 'w')
+        write_plan(records, stream)
+        _close_stream(stream)
+    return status_code
+
+
+def plan_many():
+    '''Method that plans a batch job over many roots in parallel'''
+
+    from _multiroot import make_shards, plan_roots
+    from _plan import write_plan
+
+    if not args.plan:
+        error("--roots can only be used together with --plan.", "plan")
+        return 1
+    # Check the offsets before any worker process is started
+    options = plan_options()
+    if options is None:
+        return 1
+    shards = make_shards(args.roots, args.shard)
+    status_code, records = plan_roots(shards, options, args.processes)
+
+    stream = _open_stream(args.plan, 'w')
+    write_plan(records, stream)
+    _close_stream(stream)
+    print("Planned {0} videos in {1} shards.".format(
+        len(records), len(shards)), file=sys.stderr)
+    return status_code
+
+
+def apply():
+    '''Method that applies a plan written by --plan without prompting'''
+
+    from _journal import default_journal_path, journal_root
+    from _plan import read_plan, apply_plan
+
+    try:
+        stream = _open_stream(args.apply_plan, 'r')
+        records = read_plan(stream)
+        _close_stream(stream)
+    except (OSError, ValueError) as exc:
+        error("Invalid plan file: " + str(exc), "plan")
+        return 1
+    return apply_plan(records, sys.stdout, args.apply_workers,
+                      args.device_limit, args.timeout,
+                      args.journal or default_journal_path(
+                          journal_root(records)),
+                      sidecars=not args.no_sidecars)
+
+
+def recover():
+    '''Method that resumes or rolls back the batch recorded in the
+    journal without prompting'''
+
+    from _journal import read_journal, default_journal_path, \
+        latest_journal
+    from _plan import apply_plan
+
+    # Recover the batch of --path if given, otherwise the last one
+    path = args.journal or (default_journal_path(args.path) if args.path
+                            else latest_journal())
+    if path is None:
+        error("No journal found.", "journal")
+        return 1
+    try:
+        state = read_journal(path)
+    except (OSError, ValueError, KeyError) as exc:
+        error("Invalid journal: " + str(exc), "journal")
+        return 1
+
+    if args.rollback:
+        records = state.inverse()
+        # Undoing the batch is a new batch of its own
+        resumed = None
+    elif state.committed:
+        print("The last batch completed, nothing to resume.",
+              file=sys.stderr)
+        return 0
+    else:
+        records = state.remaining()
+        resumed = state
+    print("{0} {1} videos.".format(
+        "Rolling back" if args.rollback else "Resuming", len(records)),
+        file=sys.stderr)
+    # The recovery is journaled in turn, so that it can be resumed too
+    return apply_plan(records, sys.stdout, args.apply_workers,
+                      args.device_limit, args.timeout, path, resumed,
+                      not args.no_sidecars)
+
+
+def watch():
+    '''Method that edits new videos as they arrive in a directory'''
+
+    from _watch import WatchSession, load_rules
+
+    wd = os.path.expanduser(args.path or os.curdir)
+    if not os.path.isdir(wd):
+        error("Directory not found.", "watch")
+        return 1
+    os.chdir(wd)
+
+    if args.rules:
+        try:
+            rules = load_rules(args.rules)
+        except (OSError, ValueError) as exc:
+            error("Invalid rules file: " + str(exc), "watch")
+            return 1
+    else:
+        rules = {
+            'm_pattern': args.m_pattern or '\\',
+            'f_pattern': args.f_pattern or '\\',
+            'offset': parse_offset(args.offset),
+            'regex': args.regex,
+        }
+        if rules['offset'] is None:
+            error("Invalid offsets passed.", "watch")
+            return 1
+
+    try:
+        session = WatchSession(
+            os.curdir, rules, extensions_for(args.types), args.settle,
+            workers=args.apply_workers, device_limit=args.device_limit,
+            sidecars=not args.no_sidecars)
+    except PatternError as exc:
+        error(str(exc), "watch")
+        return 1
+    return session.run()
+
+
 if __name__ == "__main__":
+    import argparse
+
     # Initialize the argument parsing library
     parser = argparse.ArgumentParser(
         description="Batch edit video files' metadata")
@@ -356,10 +612,256 @@ if __name__ == "__main__":
         default=None,
         help='specify the mode to run the script in - single or batch.'
     )
+    # Add argument to specify the number of concurrent metadata probes
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=None,
+        help='specify the number of files to probe concurrently.'
+    )
+    # Add argument to specify the time limit of a single metadata probe
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=float,
+        default=None,
+        help='specify the number of seconds after which probing a file '
+        'is abandoned.'
+    )
+    # Add argument to specify how many videos to probe ahead in single mode
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=4,
+        help='specify the number of upcoming videos to probe in the '
+        'background in single mode.'
+    )
+    # Add argument to disable the persistent title cache
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help='don\'t read or store probed titles in the metadata cache or '
+        'the fingerprint index.'
+    )
+    # Add argument to specify the number of concurrent metadata edits
+    parser.add_argument(
+        '--apply_workers',
+        type=int,
+        default=None,
+        help='specify the number of videos to edit concurrently.'
+    )
+    # Add argument to limit the concurrent metadata edits per device
+    parser.add_argument(
+        '--device_limit',
+        type=int,
+        default=None,
+        help='specify the number of videos to edit concurrently on the '
+        'same device, use 1 for spinning disks. Can\'t be used with '
+        '--use_asyncio.'
+    )
+    # Add argument to leave the subtitle files of renamed videos alone
+    parser.add_argument(
+        '--no_sidecars',
+        action='store_true',
+        help='don\'t move the subtitle files next to a video (e.g. '
+        'video.en.srt) when it is renamed.'
+    )
+    # Add arguments to control which files the directory scan picks up
+    parser.add_argument(
+        '--types',
+        nargs='+',
+        choices=list(BACKENDS),
+        default=list(BACKENDS),
+        help='specify the video containers to look for.'
+    )
+    parser.add_argument(
+        '--hidden',
+        action='store_true',
+        help='include hidden files and directories in the scan.'
+    )
+    parser.add_argument(
+        '--no_follow',
+        action='store_true',
+        help='don\'t descend into symlinked directories.'
+    )
+    parser.add_argument(
+        '--prune',
+        nargs='+',
+        default=None,
+        help='specify glob patterns of directory names to skip.'
+    )
+    # Add arguments to run the script in watch mode
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='keep running and edit new videos as they arrive in the '
+        'directory, using the patterns given or loaded with --rules.'
+    )
+    parser.add_argument(
+        '--rules',
+        default=None,
+        help='specify a rules file saved with --save_rules to use in '
+        'watch mode.'
+    )
+    parser.add_argument(
+        '--save_rules',
+        default=None,
+        help='save the patterns and offset given on the command line to '
+        'a rules file.'
+    )
+    parser.add_argument(
+        '--settle',
+        type=float,
+        default=10.0,
+        help='specify the number of seconds a new video must stay '
+        'unchanged before it is edited in watch mode.'
+    )
+    # Add argument to capture parts of the filenames for the patterns
+    parser.add_argument(
+        '-r',
+        '--regex',
+        default=None,
+        help='specify a regular expression matched against the current '
+        'filenames, its groups are available as {re[1]} or {re[name]}.'
+    )
+    # Add arguments to plan and apply batch jobs without any prompts
+    parser.add_argument(
+        '--plan',
+        default=None,
+        help='write the edits of a batch job on --path to a JSON lines '
+        'plan file (- for standard output) instead of applying them.'
+    )
+    parser.add_argument(
+        '--apply_plan',
+        default=None,
+        help='apply a plan file written by --plan (- for standard input) '
+        'and stream the result of every step as JSON lines.'
+    )
+    # Add arguments to plan many library roots in parallel
+    parser.add_argument(
+        '--roots',
+        nargs='+',
+        default=None,
+        help='specify several directories to plan in parallel processes, '
+        'requires --plan.'
+    )
+    parser.add_argument(
+        '--shard',
+        action='store_true',
+        help='plan every top level directory of the roots in a process '
+        'of its own, numbering each of them separately.'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='specify the number of processes used with --roots.'
+    )
+    # Add arguments to recover from interrupted batches
+    parser.add_argument(
+        '--journal',
+        default=None,
+        help='specify the journal file recording the progress of every '
+        'batch, defaults to a journal per directory in the cache directory.'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='finish the edits of the last batch recorded in the journal '
+        'of --path, or of the last batch applied anywhere.'
+    )
+    parser.add_argument(
+        '--rollback',
+        action='store_true',
+        help='undo the edits of the last batch recorded in the journal '
+        'of --path, or of the last batch applied anywhere.'
+    )
+    # Add argument to run the external tools on an asyncio event loop
+    parser.add_argument(
+        '--use_asyncio',
+        action='store_true',
+        help='run mediainfo and mkvpropedit on an asyncio event loop, '
+        'showing every video in single mode as soon as its title arrives. '
+        '--workers then caps the number of tools running at once, per '
+        'device limits are not supported.'
+    )
+    # Add arguments to record where the time goes
+    parser.add_argument(
+        '--metrics',
+        default=None,
+        help='write the counters and latency histograms of the run to '
+        'a JSON file.'
+    )
+    parser.add_argument(
+        '--trace',
+        default=None,
+        help='write the timed steps of the run to a file in the Chrome '
+        'trace format.'
+    )
+    # Add argument to show the debug messages
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        help='show the debug messages of every step.'
+    )
     args = parser.parse_args()
-    debug(str(args), "run")
-
-    while True:
+    # The event loop caps the tools as a whole, it has no per device limit
+    if args.use_asyncio and args.device_limit is not None:
+        parser.error("--device_limit can't be used with --use_asyncio")
+    configure(args.verbose)
+    debug("%s", "run", args)
+
+    # The runs change the working directory
+    args.journal = args.journal and os.path.abspath(args.journal)
+    if args.metrics or args.trace:
+        args.metrics = args.metrics and os.path.abspath(args.metrics)
+        args.trace = args.trace and os.path.abspath(args.trace)
+        metrics.enable(tracing=bool(args.trace))
+
+    # Share the title cache and the fingerprint index between every run of
+    # the loop below, they are only opened once a title is looked up
+    if not args.no_cache:
+        Video.cache = lazy_cache()
+        Video.fingerprints = lazy_fingerprints()
+    # Start the event loop shared by every run of the loop below
+    pipeline = None
+    if args.use_asyncio:
+        from _async import AsyncPipeline
+        pipeline = AsyncPipeline(args.workers)
+
+    if args.save_rules:
+        from _watch import save_rules
+        offset = parse_offset(args.offset)
+        if offset is None:
+            error("Invalid offsets passed.", "run")
+        else:
+            try:
+                save_rules(args.save_rules, args.m_pattern, args.f_pattern,
+                           offset, args.regex)
+            except OSError:
+                error("Failed to save the rules file.", "run")
+            else:
+                debug("Saved rules to " + args.save_rules, "run")
+
+    # Headless modes run once without any prompts
+    headless = args.watch or args.plan or args.roots or args.apply_plan or \
+        args.resume or args.rollback
+    if args.resume or args.rollback:
+        status_code = recover()
+    elif args.roots:
+        status_code = plan_many()
+    elif args.plan:
+        status_code = plan()
+    elif args.apply_plan:
+        status_code = apply()
+    elif args.watch:
+        status_code = watch()
+    if headless and status_code == 1:
+        print("The script encountered an error.", file=sys.stderr)
+
+    while not headless:
         status_code = run()
         if status_code == 1:
             print("The script encountered an error.")
@@ -378,3 +880,18 @@ if __name__ == "__main__":
         else:
             debug("Exiting...", "run")
             break
+
+    if pipeline is not None:
+        pipeline.close()
+    if Video.cache is not None:
+        Video.cache.close()
+    if Video.fingerprints is not None:
+        Video.fingerprints.close()
+
+    try:
+        if args.metrics:
+            metrics.write_json(args.metrics)
+        if args.trace:
+            metrics.write_trace(args.trace)
+    except OSError:
+        error("Failed to write the metrics.", "run")